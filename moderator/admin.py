@@ -1,11 +1,13 @@
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
 from django.contrib.admin.templatetags.admin_static import static
 from django.contrib.admin.util import unquote
 from django.contrib.admin.views.main import ChangeList
 from django.contrib.comments.admin import CommentsAdmin as DjangoCommentsAdmin
 from django.contrib.comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import InvalidPage
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.db.models import Q
@@ -15,9 +17,48 @@ from django.template import defaultfilters
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_protect
 from moderator import models, utils
+from moderator.paginator import CappedCountPaginator, decode_cursor, \
+    encode_cursor, get_keyset_page
 
 csrf_protect_m = method_decorator(csrf_protect)
 
+# Changelist query string parameter requesting an exact result count.
+EXACT_COUNT_VAR = 'exact_count'
+# Changelist query string parameters holding keyset pagination cursors.
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+# Actions only offered if CLUSTERING is set.
+CLUSTER_ACTIONS = ('mark_cluster_ham', 'mark_cluster_spam')
+
+
+def get_content_objects(model_class, object_pks):
+    """
+    Returns a dictionary mapping comments' object_pks to the model_class
+    objects they refer to, fetched with a single query. Object pks that
+    aren't valid primary keys for model_class are left out.
+    """
+    if model_class is None:
+        return {}
+    pks = {}
+    for object_pk in object_pks:
+        try:
+            pk = model_class._meta.pk.to_python(object_pk)
+        except ValidationError:
+            continue
+        if pk is not None:
+            pks[object_pk] = pk
+    objects = model_class._default_manager.in_bulk(list(set(pks.values())))
+    return dict(
+        (object_pk, objects[pk]) for object_pk, pk in pks.items()
+        if pk in objects
+    )
+
+
+class BlockedPhraseAdmin(admin.ModelAdmin):
+    list_display = ('phrase', 'cls', )
+    list_filter = ('cls', )
+    search_fields = ('phrase', )
+
 
 class CannedReplyAdmin(admin.ModelAdmin):
     list_display = ('comment', 'site', )
@@ -79,9 +120,68 @@ class CommentAdmin(DjangoCommentsAdmin):
         'mark_ham',
         'mark_spam',
         'mark_spam_with_reply',
+        'mark_cluster_ham',
+        'mark_cluster_spam',
     ]
 
     date_hierarchy = None
+    change_list_template = 'admin/moderator/comment_change_list.html'
+
+    # Whether to paginate with keyset pagination cursors when the
+    # KEYSET_PAGINATION setting is enabled.
+    keyset_pagination = False
+    keyset_date_field = 'submit_date'
+    # Whether to list removed comments, only applies to classified comments.
+    list_removed = False
+
+    def changelist_view(self, request, extra_context=None):
+        """
+        Strip the exact count and keyset cursor parameters, which ChangeList
+        would otherwise treat as lookups, flagging them on the request
+        instead.
+        """
+        params = (EXACT_COUNT_VAR, AFTER_VAR, BEFORE_VAR)
+        if any(param in request.GET for param in params):
+            request.GET = request.GET.copy()
+            if EXACT_COUNT_VAR in request.GET:
+                del request.GET[EXACT_COUNT_VAR]
+                request.exact_count = True
+            for param in (AFTER_VAR, BEFORE_VAR):
+                if param in request.GET:
+                    request.keyset_cursor = (param, request.GET.pop(param)[0])
+        return super(CommentAdmin, self).changelist_view(
+            request,
+            extra_context
+        )
+
+    def uses_keyset_pagination(self):
+        return self.keyset_pagination and \
+            utils.get_setting('KEYSET_PAGINATION')
+
+    def get_paginator(self, request, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        """
+        If CHANGELIST_COUNT_CAP is set count at most that many comments
+        unless an exact count is requested or cached.
+        """
+        cap = utils.get_setting('CHANGELIST_COUNT_CAP')
+        if not cap:
+            return super(CommentAdmin, self).get_paginator(
+                request,
+                queryset,
+                per_page,
+                orphans,
+                allow_empty_first_page
+            )
+        return CappedCountPaginator(
+            queryset,
+            per_page,
+            orphans,
+            allow_empty_first_page,
+            cap=cap,
+            exact=getattr(request, 'exact_count', False),
+            timeout=utils.get_setting('COUNT_CACHE_TIMEOUT')
+        )
 
     def queryset(self, request):
         """
@@ -92,15 +192,35 @@ class CommentAdmin(DjangoCommentsAdmin):
         as cls.
         """
         qs = super(CommentAdmin, self).queryset(request)
-        qs = qs.filter(
-            Q(user__is_staff=False) | Q(user__isnull=True),
-            is_removed=False
-        )
         cls = getattr(self, 'cls', None)
         if cls:
-            qs = qs.filter(classifiedcomment__cls=self.cls)
+            # Filter on fields denormalized onto ClassifiedComment, which are
+            # indexed together, instead of across comments and users.
+            lookups = {
+                'classifiedcomment__cls': cls,
+                'classifiedcomment__staff_authored': False,
+            }
+            if not self.list_removed:
+                lookups['classifiedcomment__is_removed'] = False
+            # Comments have at most one classification, so it can be joined
+            # in for keyset cursors and display.
+            qs = qs.filter(**lookups).select_related('classifiedcomment')
+        else:
+            qs = qs.filter(
+                Q(user__is_staff=False) | Q(user__isnull=True),
+                is_removed=False
+            )
         return qs.select_related('user', 'content_type')
 
+    def get_ordering(self, request):
+        """
+        Order classified comments by their denormalized submit date so
+        listings are ordered by the same index they're filtered by.
+        """
+        if getattr(self, 'cls', None):
+            return ('-classifiedcomment__submit_date', )
+        return super(CommentAdmin, self).get_ordering(request)
+
     def add_moderator_reply(self, modeladmin, request, queryset):
         selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
         request.session["admin_redirect"] = request.get_full_path()
@@ -111,11 +231,10 @@ class CommentAdmin(DjangoCommentsAdmin):
     add_moderator_reply.short_description = "Add moderator reply"
 
     def mark_spam(self, modeladmin, request, queryset):
-        for comment in queryset:
-            utils.classify_comment(comment, cls='spam')
+        counts = utils.classify_comments(queryset, cls='spam')
         self.message_user(
             request,
-            "%s comment(s) successfully marked as spam." % queryset.count()
+            "%s comment(s) successfully marked as spam." % counts.get('spam', 0)
         )
     mark_spam.short_description = "Mark selected comments as spam"
 
@@ -125,17 +244,56 @@ class CommentAdmin(DjangoCommentsAdmin):
     mark_spam_with_reply.short_description = "Mark selected comments as spam, replying at the same time."
 
     def mark_ham(self, modeladmin, request, queryset):
-        for comment in queryset:
-            utils.classify_comment(comment, cls='ham')
+        counts = utils.classify_comments(queryset, cls='ham')
         self.message_user(
             request,
-            "%s comment(s) successfully marked as ham." % queryset.count()
+            "%s comment(s) successfully marked as ham." % counts.get('ham', 0)
         )
     mark_ham.short_description = "Mark selected comments as ham"
 
+    def get_cluster_queryset(self, queryset):
+        """
+        Returns all comments in the clusters of near-duplicates of comments in
+        queryset, including the comments themselves.
+        """
+        selected_ids = list(queryset.values_list('pk', flat=True))
+        cluster_ids = models.ClassifiedComment.objects.filter(
+            comment__in=selected_ids,
+            cluster__isnull=False
+        ).values_list('cluster', flat=True)
+        return Comment.objects.filter(
+            Q(classifiedcomment__cluster__in=list(cluster_ids)) |
+            Q(pk__in=selected_ids)
+        )
+
+    def mark_cluster_spam(self, modeladmin, request, queryset):
+        counts = utils.classify_comments(
+            self.get_cluster_queryset(queryset),
+            cls='spam'
+        )
+        self.message_user(
+            request,
+            "%s comment(s) successfully marked as spam." % counts.get('spam', 0)
+        )
+    mark_cluster_spam.short_description = "Mark selected comments and their near-duplicates as spam"
+
+    def mark_cluster_ham(self, modeladmin, request, queryset):
+        counts = utils.classify_comments(
+            self.get_cluster_queryset(queryset),
+            cls='ham'
+        )
+        self.message_user(
+            request,
+            "%s comment(s) successfully marked as ham." % counts.get('ham', 0)
+        )
+    mark_cluster_ham.short_description = "Mark selected comments and their near-duplicates as ham"
+
     def get_actions(self, request):
         actions = {}
         for action in self.actions:
+            if action in CLUSTER_ACTIONS and \
+                    not utils.get_setting('CLUSTERING'):
+                continue
             actions[action] = (
                 getattr(self, action),
                 action,
@@ -170,40 +328,139 @@ class CommentAdmin(DjangoCommentsAdmin):
                 lookups per comment object
                 (used in CommentAdmin.moderator_reply method)
                 """
-                super(ModeratorChangeList, self).get_results(request)
-                comment_ids = []
-                object_pks = []
-
+                paginator = self.model_admin.get_paginator(
+                    request,
+                    self.query_set,
+                    self.list_per_page
+                )
+                if self.model_admin.uses_keyset_pagination():
+                    self.get_keyset_results(request)
+                elif isinstance(paginator, CappedCountPaginator):
+                    self.get_capped_results(request, paginator)
+                else:
+                    super(ModeratorChangeList, self).get_results(request)
                 results = list(self.result_list)
-                for obj in results:
-                    comment_ids.append(obj.id)
-                    object_pks.append(obj.object_pk)
+                comment_ids = [obj.id for obj in results]
 
-                ct_map = {}
+                # Fetch each content type's objects once, limited to the
+                # objects commented on for that content type.
+                object_pks = {}
                 for obj in results:
-                    if obj.content_type not in ct_map:
-                        ct_map.setdefault(obj.content_type, {})
-                        for content_obj in obj.content_type.model_class()._default_manager.filter(pk__in=object_pks):
-                            ct_map[obj.content_type][content_obj.id] = content_obj
+                    object_pks.setdefault(obj.content_type, set()).add(
+                        obj.object_pk
+                    )
+                ct_map = {}
+                for content_type, pks in object_pks.items():
+                    ct_map[content_type] = get_content_objects(
+                        content_type.model_class(),
+                        pks
+                    )
                 self.model_admin.ct_map = ct_map
 
+                # Resolve replies through the m2m table in a single query.
                 comment_replies = {}
-                for comment_reply in models.CommentReply.objects.filter(replied_to_comments__in=comment_ids):
-                    for replied_to_comment in comment_reply.replied_to_comments.all():
-                        comment_replies[replied_to_comment.id] = {
-                            'id': comment_reply.id,
-                            'comment': comment_reply.comment_text,
-                        }
+                replied_to_comments = models.CommentReply.\
+                    replied_to_comments.through.objects.filter(
+                        comment__in=comment_ids
+                    ).select_related('commentreply__canned_reply')
+                for replied_to_comment in replied_to_comments:
+                    comment_replies[replied_to_comment.comment_id] = {
+                        'id': replied_to_comment.commentreply_id,
+                        'comment': replied_to_comment.commentreply.comment_text,
+                    }
                 self.model_admin.comment_replies = comment_replies
 
+            def get_keyset_results(self, request):
+                """
+                Fetches the page of comments located by the request's keyset
+                cursor, avoiding OFFSET queries and counts altogether.
+                """
+                cursors = {}
+                cursor = getattr(request, 'keyset_cursor', None)
+                if cursor:
+                    try:
+                        cursors[cursor[0]] = decode_cursor(cursor[1])
+                    except ValueError:
+                        raise IncorrectLookupParameters
+                date_field = self.model_admin.keyset_date_field
+                result_list, has_previous, has_next = get_keyset_page(
+                    self.query_set,
+                    date_field,
+                    self.list_per_page,
+                    **cursors
+                )
+
+                def get_cursor_url(param, obj):
+                    value = obj
+                    for attr in date_field.split('__'):
+                        value = getattr(value, attr)
+                    return self.get_query_string(
+                        {param: encode_cursor(value, obj.pk)},
+                        [AFTER_VAR, BEFORE_VAR]
+                    )
+
+                self.keyset_previous_url = None
+                self.keyset_next_url = None
+                if result_list and has_previous:
+                    self.keyset_previous_url = get_cursor_url(
+                        BEFORE_VAR,
+                        result_list[0]
+                    )
+                if result_list and has_next:
+                    self.keyset_next_url = get_cursor_url(
+                        AFTER_VAR,
+                        result_list[-1]
+                    )
+
+                self.result_count = len(result_list)
+                self.full_result_count = len(result_list)
+                self.result_list = result_list
+                self.can_show_all = False
+                self.multi_page = False
+                self.keyset = True
+
+            def get_capped_results(self, request, paginator):
+                """
+                Mirrors ChangeList.get_results, but also caps the count of
+                unfiltered comments instead of counting them exactly.
+                """
+                result_count = paginator.count
+                if not self.query_set.query.where:
+                    full_result_count = result_count
+                else:
+                    full_result_count = self.model_admin.get_paginator(
+                        request,
+                        self.root_query_set,
+                        self.list_per_page
+                    ).count
+
+                can_show_all = result_count <= self.list_max_show_all
+                multi_page = result_count > self.list_per_page
+                if (self.show_all and can_show_all) or not multi_page:
+                    result_list = self.query_set._clone()
+                else:
+                    try:
+                        result_list = paginator.page(
+                            self.page_num + 1
+                        ).object_list
+                    except InvalidPage:
+                        raise IncorrectLookupParameters
+
+                self.result_count = result_count
+                self.full_result_count = full_result_count
+                self.result_list = result_list
+                self.can_show_all = can_show_all
+                self.multi_page = multi_page
+                self.paginator = paginator
+                self.exact_count_url = self.get_query_string({
+                    EXACT_COUNT_VAR: 1
+                })
+
         return ModeratorChangeList
 
     def content(self, obj, *args, **kwargs):
         content_type = obj.content_type
-        if not int(obj.object_pk) in self.ct_map[content_type]:
-            content = obj
-        else:
-            content = self.ct_map[content_type][int(obj.object_pk)]
+        content = self.ct_map[content_type].get(obj.object_pk, obj)
         url = reverse('admin:%s_%s_moderate' % (
             content_type.app_label,
             content_type.model
@@ -270,48 +527,55 @@ class CommentAdmin(DjangoCommentsAdmin):
         return obj.user
 
 
+class DomainReputationAdmin(admin.ModelAdmin):
+    list_display = ('domain', 'spam_count', 'ham_count', )
+    search_fields = ('domain', )
+
+
 class HamCommentAdmin(CommentAdmin):
     cls = 'ham'
     actions = ['add_moderator_reply', 'mark_spam', 'mark_spam_with_reply', ]
     raw_id_fields = ('user', )
 
 
+class RegexRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'pattern', 'cls', 'is_active', )
+    list_filter = ('cls', 'is_active', )
+    search_fields = ('name', 'pattern', )
+
+
 class ReportedCommentAdmin(CommentAdmin):
     cls = 'reported'
+    list_removed = True
+    keyset_pagination = True
+    keyset_date_field = 'classifiedcomment__submit_date'
     actions = [
         'add_moderator_reply',
         'mark_ham',
         'mark_spam',
         'mark_spam_with_reply',
+        'mark_cluster_ham',
+        'mark_cluster_spam',
     ]
 
-    def queryset(self, request):
-        qs = super(CommentAdmin, self).queryset(request)
-        qs = qs.filter(
-            Q(user__is_staff=False) | Q(user__isnull=True)
-        ).filter(classifiedcomment__cls=self.cls)
-        return qs.select_related('user', 'content_type')
-
 
 class SpamCommentAdmin(CommentAdmin):
     cls = 'spam'
+    list_removed = True
     actions = ['mark_ham', ]
 
-    def queryset(self, request):
-        qs = super(CommentAdmin, self).queryset(request)
-        qs = qs.filter(
-            Q(user__is_staff=False) | Q(user__isnull=True)
-        ).filter(classifiedcomment__cls=self.cls)
-        return qs.select_related('user', 'content_type')
-
 
 class UnsureCommentAdmin(CommentAdmin):
     cls = 'unsure'
+    keyset_pagination = True
+    keyset_date_field = 'classifiedcomment__submit_date'
     actions = [
         'add_moderator_reply',
         'mark_ham',
         'mark_spam',
         'mark_spam_with_reply',
+        'mark_cluster_ham',
+        'mark_cluster_spam',
     ]
 
 
@@ -386,11 +650,14 @@ class AdminModeratorMixin(object):
         return view.changelist_view(request, extra_context)
 
 
+admin.site.register(models.BlockedPhrase, BlockedPhraseAdmin)
 admin.site.register(models.CannedReply, CannedReplyAdmin)
 admin.site.unregister(Comment)
 admin.site.register(Comment, CommentAdmin)
 admin.site.register(models.CommentReply, CommentReplyAdmin)
+admin.site.register(models.DomainReputation, DomainReputationAdmin)
 admin.site.register(models.HamComment, HamCommentAdmin)
+admin.site.register(models.RegexRule, RegexRuleAdmin)
 admin.site.register(models.ReportedComment, ReportedCommentAdmin)
 admin.site.register(models.SpamComment, SpamCommentAdmin)
 admin.site.register(models.UnsureComment, UnsureCommentAdmin)
@@ -0,0 +1,70 @@
+from moderator import utils
+
+
+class CoalescingQueue(object):
+    """
+    Buffers ids in a Redis set, deduplicating them, and schedules a single
+    task per window to process everything buffered in the meantime.
+
+    The task is expected to call pop to collect the buffered ids.
+    """
+    def __init__(self, name, task):
+        self.key = 'moderator:queue:%s' % name
+        self.scheduled_key = 'moderator:queue:%s:scheduled' % name
+        self.task = task
+
+    def add(self, ids, window):
+        """
+        Buffers ids, scheduling the task to run in window seconds unless it
+        has already been scheduled.
+        """
+        if not ids:
+            return
+        pipe = utils.get_redis_client().pipeline()
+        self.push(pipe, ids)
+        # Expire the schedule marker well after the task is due so a lost
+        # task doesn't stall the queue indefinitely.
+        pipe.set(self.scheduled_key, 1, nx=True, ex=max(window * 2, 1))
+        added, scheduled = pipe.execute()
+        if scheduled:
+            self.task.apply_async(countdown=window)
+
+    def push(self, pipe, ids):
+        pipe.sadd(self.key, *ids)
+
+    def pop(self):
+        """
+        Atomically removes and returns all buffered ids.
+
+        The schedule marker is cleared first so ids buffered from here on
+        schedule a new task rather than waiting for the marker to expire.
+        """
+        client = utils.get_redis_client()
+        client.delete(self.scheduled_key)
+        pipe = client.pipeline()
+        pipe.smembers(self.key)
+        pipe.delete(self.key)
+        ids, deleted = pipe.execute()
+        return sorted(int(i) for i in ids)
+
+
+class OrderedCoalescingQueue(CoalescingQueue):
+    """
+    CoalescingQueue buffering items in a Redis list instead, preserving
+    their order and duplicates.
+    """
+    def push(self, pipe, items):
+        pipe.rpush(self.key, *items)
+
+    def pop(self):
+        """
+        Atomically removes and returns all buffered items, in the order they
+        were added.
+        """
+        client = utils.get_redis_client()
+        client.delete(self.scheduled_key)
+        pipe = client.pipeline()
+        pipe.lrange(self.key, 0, -1)
+        pipe.delete(self.key)
+        items, deleted = pipe.execute()
+        return items
@@ -0,0 +1,165 @@
+"""
+Clusters near-duplicate comments using MinHash locality sensitive hashing.
+
+A comment's text is reduced to a set of word bigram shingles, summarized by
+a MinHash signature whose rows estimate the Jaccard similarity of shingle
+sets. Signatures are split into bands, each band hashed into a bucket.
+Comments sharing a bucket in any band are likely similar, with comments at
+least about 50% similar very likely to share one.
+
+Buckets are stored in the indexed ClusterBand table, mapping them to the
+first comment, the cluster root, landing in them. Clustering a comment
+looks up its buckets, independently of the number of comments clustered.
+"""
+import hashlib
+import struct
+import zlib
+
+from django.contrib.comments.models import Comment
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from moderator import models, tokenizer, utils
+import numpy
+
+
+BANDS = 16
+ROWS_PER_BAND = 4
+# Texts with fewer tokens are too short to tell near-duplicates apart.
+MINIMUM_TOKENS = 3
+
+# Smallest prime larger than any 32 bit shingle hash, the random hash
+# functions (a * x + b) % PRIME fit in 64 bits.
+PRIME = numpy.uint64(4294967311)
+_random = numpy.random.RandomState(2147483647)
+PERMUTATION_A = _random.randint(1, 2 ** 31, BANDS * ROWS_PER_BAND).astype(
+    numpy.uint64
+)
+PERMUTATION_B = _random.randint(0, 2 ** 31, BANDS * ROWS_PER_BAND).astype(
+    numpy.uint64
+)
+
+
+def get_signature(text):
+    """
+    Returns text's MinHash signature, or None if it is too short.
+    """
+    tokens = tokenizer.tokenize(text or '')
+    if len(tokens) < MINIMUM_TOKENS:
+        return None
+    shingles = numpy.array([
+        zlib.crc32(shingle.encode('utf-8')) & 0xffffffff
+        for shingle in set(tokenizer.ngrams(tokens, 2))
+    ], dtype=numpy.uint64)
+    hashes = (
+        PERMUTATION_A[:, numpy.newaxis] * shingles[numpy.newaxis, :] +
+        PERMUTATION_B[:, numpy.newaxis]
+    ) % PRIME
+    return hashes.min(axis=1)
+
+
+def get_buckets(text):
+    """
+    Returns a list of (band, bucket) tuples for text, empty if it is too
+    short.
+    """
+    signature = get_signature(text)
+    if signature is None:
+        return []
+    buckets = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.md5(rows.tobytes()).digest()
+        buckets.append((band, struct.unpack('>q', digest[:8])[0]))
+    return buckets
+
+
+def assign_clusters(comment_ids):
+    """
+    Assigns classified comments to the clusters of comments similar to them
+    or, if there are none, to clusters of their own.
+
+    Returns a dictionary mapping comment ids to their cluster roots.
+    """
+    clusters = {}
+    for offset in range(0, len(comment_ids), utils.BULK_CHUNK_SIZE):
+        clusters.update(_assign_clusters(
+            comment_ids[offset:offset + utils.BULK_CHUNK_SIZE]
+        ))
+    return clusters
+
+
+def _assign_clusters(comment_ids):
+    """
+    Assigns a chunk of comments to clusters, looking up and inserting
+    buckets in batches of at most BULK_CHUNK_SIZE parameters, with an update
+    per cluster joined.
+    """
+    texts = dict(Comment.objects.filter(
+        pk__in=comment_ids
+    ).values_list('pk', 'comment'))
+    comment_buckets = dict(
+        (comment_id, get_buckets(texts.get(comment_id)))
+        for comment_id in comment_ids
+    )
+    buckets = list(set(
+        bucket for keys in comment_buckets.values() for band, bucket in keys
+    ))
+    roots = {}
+    for offset in range(0, len(buckets), utils.BULK_CHUNK_SIZE):
+        for band, bucket, root_id in models.ClusterBand.objects.filter(
+            bucket__in=buckets[offset:offset + utils.BULK_CHUNK_SIZE]
+        ).values_list('band', 'bucket', 'cluster'):
+            roots[(band, bucket)] = root_id
+
+    clusters = {}
+    new_bands = []
+    for comment_id in comment_ids:
+        keys = comment_buckets[comment_id]
+        if not keys:
+            continue
+        matches = [roots[key] for key in keys if key in roots]
+        root_id = min(matches) if matches else comment_id
+        clusters[comment_id] = root_id
+        for key in keys:
+            if key not in roots:
+                roots[key] = root_id
+                new_bands.append(models.ClusterBand(
+                    band=key[0],
+                    bucket=key[1],
+                    cluster_id=root_id
+                ))
+
+    sid = transaction.savepoint()
+    try:
+        utils.bulk_create(models.ClusterBand, new_bands)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Buckets taken concurrently in the meantime, they belong to other
+        # clusters now.
+        transaction.savepoint_rollback(sid)
+        for cluster_band in new_bands:
+            sid = transaction.savepoint()
+            try:
+                cluster_band.save()
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+
+    members = {}
+    for comment_id, root_id in clusters.items():
+        members.setdefault(root_id, []).append(comment_id)
+    # Comments starting their own clusters are updated at once.
+    roots_ids = [
+        root_id for root_id, member_ids in members.items()
+        if member_ids == [root_id]
+    ]
+    if roots_ids:
+        models.ClassifiedComment.objects.filter(
+            comment__in=roots_ids
+        ).update(cluster=F('comment'))
+    for root_id, member_ids in members.items():
+        if member_ids != [root_id]:
+            models.ClassifiedComment.objects.filter(
+                comment__in=member_ids
+            ).update(cluster=root_id)
+    return clusters
@@ -1,7 +1,35 @@
 DEFAULT_CONFIG = {
     'ABUSE_CUTOFF': 3,
+    'ABUSE_COUNTER': 'moderator.counters.DatabaseAbuseCounter',
+    'ASYNC_CLASSIFICATION': False,
+    'CHANGELIST_COUNT_CAP': None,
+    'CLASSIFICATION_STAGES': [],
+    'CLASSIFIER': None,
+    'CLASSIFIER_CONFIG': {},
+    'CLASSIFY_COALESCE_WINDOW': 0,
+    'CLUSTERING': False,
+    'COUNT_CACHE_TIMEOUT': 300,
+    'DOMAIN_REPUTATION': False,
+    'DOMAIN_REPUTATION_CACHE_TIMEOUT': 60,
+    'DOMAIN_SPAM_CUTOFF': 0.9,
+    'DOMAIN_SPAM_MINIMUM': 3,
+    'FLAG_COALESCE_WINDOW': 0,
+    'HAM_CUTOFF': 0.3,
+    'KEYSET_PAGINATION': False,
+    'ONLINE_TRAINING_WINDOW': 0,
+    'REPLY_BEFORE_COMMENT': False,
+    'REDIS': {},
+    'REDIS_CLIENT': 'redis.StrictRedis',
+    'SPAM_CUTOFF': 0.7,
+    'VERDICT_CACHE_TIMEOUT': 0,
 }
 
+# Classes rules classify comments as.
+RULE_CLASS_CHOICES = (
+    ('spam', 'Spam'),
+    ('unsure', 'Unsure'),
+)
+
 CLASS_CHOICES = (
     ('reported', 'Reported'),
     ('spam', 'Spam'),
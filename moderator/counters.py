@@ -0,0 +1,88 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from moderator import models, utils
+
+
+class DatabaseAbuseCounter(object):
+    """
+    Stores abuse counts in the CommentAbuseCount table.
+    """
+    def incr(self, comment_id, amount=1):
+        """
+        Atomically adjusts a comment's abuse count by amount, creating the
+        count if the comment hasn't been reported before. Returns the new
+        count.
+
+        The count is locked with SELECT ... FOR UPDATE until it is updated,
+        so concurrent reports are serialized and each sees its own new count
+        rather than a count including later reports.
+        """
+        counts = models.CommentAbuseCount.objects.filter(comment=comment_id)
+        current = list(
+            counts.select_for_update().values_list('count', flat=True)
+        )
+        if not current:
+            if amount <= 0:
+                return 0
+            sid = transaction.savepoint()
+            try:
+                models.CommentAbuseCount.objects.create(
+                    comment_id=comment_id,
+                    count=amount
+                )
+                transaction.savepoint_commit(sid)
+                return amount
+            except IntegrityError:
+                # Created concurrently since we looked.
+                transaction.savepoint_rollback(sid)
+                current = list(
+                    counts.select_for_update().values_list('count', flat=True)
+                )
+        counts.update(count=F('count') + amount)
+        return current[0] + amount
+
+    def get_many(self, comment_ids):
+        return dict(models.CommentAbuseCount.objects.filter(
+            comment__in=comment_ids
+        ).values_list('comment_id', 'count'))
+
+    def set_many(self, counts):
+        utils.bulk_create(models.CommentAbuseCount, [
+            models.CommentAbuseCount(comment_id=comment_id, count=count)
+            for comment_id, count in counts.items()
+        ])
+
+    def clear(self):
+        models.CommentAbuseCount.objects.all().delete()
+
+
+class RedisAbuseCounter(object):
+    """
+    Stores abuse counts in a Redis hash, incremented atomically with HINCRBY,
+    so reports don't touch the database at all.
+    """
+    key = 'moderator:abuse_counts'
+
+    def __init__(self):
+        self.client = utils.get_redis_client()
+
+    def incr(self, comment_id, amount=1):
+        return self.client.hincrby(self.key, comment_id, amount)
+
+    def get_many(self, comment_ids):
+        comment_ids = list(comment_ids)
+        if not comment_ids:
+            return {}
+        counts = self.client.hmget(self.key, comment_ids)
+        return dict(
+            (comment_id, int(count))
+            for comment_id, count in zip(comment_ids, counts)
+            if count is not None
+        )
+
+    def set_many(self, counts):
+        if counts:
+            self.client.hmset(self.key, counts)
+
+    def clear(self):
+        self.client.delete(self.key)
@@ -0,0 +1,185 @@
+"""
+Domain reputation, the number of comments linking to domains moderators
+have marked as spam and ham, tracked in DomainReputation if
+DOMAIN_REPUTATION is set.
+
+Reputations are looked up through a bounded in-process LRU cache, expiring
+entries after DOMAIN_REPUTATION_CACHE_TIMEOUT seconds, so scoring links
+mostly doesn't query the database at all.
+"""
+import time
+
+from django.contrib.comments.models import Comment
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from moderator import models, tokenizer, utils
+from moderator.lru import LRUCache
+
+
+# Number of domains whose reputations are cached per process.
+REPUTATION_CACHE_SIZE = 100000
+
+_reputations = LRUCache(REPUTATION_CACHE_SIZE)
+
+
+def get_domain(host):
+    """
+    Returns the domain registered for host, without subdomains, guessing
+    two letter country code domains with short second level labels such as
+    co.uk to be public suffixes.
+    """
+    labels = host.strip('.').split('.')
+    if all(label.isdigit() for label in labels):
+        return host
+    if len(labels) > 2 and len(labels[-1]) == 2 and len(labels[-2]) <= 3:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def get_domains(text):
+    """
+    Returns the set of domains linked to in text.
+    """
+    return set(
+        get_domain(token[4:]) for token in tokenizer.tokenize(text or '')
+        if token.startswith('url:')
+    )
+
+
+def get_reputations(domains):
+    """
+    Returns a dictionary mapping domains to their (spam count, ham count)
+    reputations, querying domains not cached in batches of BULK_CHUNK_SIZE.
+    """
+    now = time.time()
+    reputations = {}
+    missing = []
+    for domain in set(domains):
+        cached = _reputations.get(domain)
+        if cached is not None and cached[0] > now:
+            reputations[domain] = cached[1]
+        else:
+            missing.append(domain)
+    if missing:
+        fetched = {}
+        for offset in range(0, len(missing), utils.BULK_CHUNK_SIZE):
+            fetched.update(
+                (domain, (spam_count, ham_count))
+                for domain, spam_count, ham_count in
+                models.DomainReputation.objects.filter(
+                    domain__in=missing[offset:offset + utils.BULK_CHUNK_SIZE]
+                ).values_list('domain', 'spam_count', 'ham_count')
+            )
+        expires = now + utils.get_setting('DOMAIN_REPUTATION_CACHE_TIMEOUT')
+        for domain in missing:
+            # Domains without reputations are cached too.
+            reputation = fetched.get(domain, (0, 0))
+            _reputations.set(domain, (expires, reputation))
+            reputations[domain] = reputation
+    return reputations
+
+
+def update_reputations(comment_ids, cls, previous_classes=None):
+    """
+    Counts moderator decisions to classify comments as cls towards the
+    reputations of the domains they link to, discounting previous decisions
+    previous_classes maps comment ids to.
+
+    Counts are updated with one statement per distinct change in counts and
+    batch of BULK_CHUNK_SIZE domains rather than per domain.
+    """
+    if not utils.get_setting('DOMAIN_REPUTATION') or not comment_ids:
+        return
+    previous_classes = previous_classes or {}
+    changes = {}
+    for comment_id, text in Comment.objects.filter(
+        pk__in=comment_ids
+    ).values_list('pk', 'comment'):
+        change = [0, 0]
+        for moderated_cls, amount in (
+            (previous_classes.get(comment_id), -1),
+            (cls, 1)
+        ):
+            if moderated_cls == 'spam':
+                change[0] += amount
+            elif moderated_cls == 'ham':
+                change[1] += amount
+        if change != [0, 0]:
+            for domain in get_domains(text):
+                domain_change = changes.setdefault(domain, [0, 0])
+                domain_change[0] += change[0]
+                domain_change[1] += change[1]
+    changes = dict(
+        (domain, tuple(change)) for domain, change in changes.items()
+        if change != [0, 0]
+    )
+    if not changes:
+        return
+
+    domains = list(changes)
+    existing = set()
+    for offset in range(0, len(domains), utils.BULK_CHUNK_SIZE):
+        existing.update(models.DomainReputation.objects.filter(
+            domain__in=domains[offset:offset + utils.BULK_CHUNK_SIZE]
+        ).values_list('domain', flat=True))
+    new_reputations = [
+        models.DomainReputation(domain=domain)
+        for domain in domains if domain not in existing
+    ]
+    sid = transaction.savepoint()
+    try:
+        utils.bulk_create(models.DomainReputation, new_reputations)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Domains created concurrently in the meantime.
+        transaction.savepoint_rollback(sid)
+        for reputation in new_reputations:
+            sid = transaction.savepoint()
+            try:
+                reputation.save()
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+
+    domains_by_change = {}
+    for domain, change in changes.items():
+        domains_by_change.setdefault(change, []).append(domain)
+    for (spam_change, ham_change), domains in domains_by_change.items():
+        for offset in range(0, len(domains), utils.BULK_CHUNK_SIZE):
+            models.DomainReputation.objects.filter(
+                domain__in=domains[offset:offset + utils.BULK_CHUNK_SIZE]
+            ).update(
+                spam_count=F('spam_count') + spam_change,
+                ham_count=F('ham_count') + ham_change
+            )
+    for domain in changes:
+        _reputations.delete(domain)
+
+
+def is_spam_domain(spam_count, ham_count):
+    """
+    Returns whether a domain's reputation marks links to it as spam.
+    """
+    return spam_count >= utils.get_setting('DOMAIN_SPAM_MINIMUM') and \
+        spam_count >= (spam_count + ham_count) * \
+        utils.get_setting('DOMAIN_SPAM_CUTOFF')
+
+
+def domain_reputation_stage(texts):
+    """
+    Classifies comments linking to domains with spam reputations as spam.
+    """
+    domains = dict(
+        (comment_id, get_domains(text)) for comment_id, text in texts.items()
+    )
+    reputations = get_reputations(
+        domain for comment_domains in domains.values()
+        for domain in comment_domains
+    )
+    classes = {}
+    for comment_id, comment_domains in domains.items():
+        for domain in comment_domains:
+            if is_spam_domain(*reputations[domain]):
+                classes[comment_id] = 'spam'
+                break
+    return classes
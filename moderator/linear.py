@@ -0,0 +1,178 @@
+import time
+import zlib
+
+from moderator import tokenizer
+from moderator.registry import ModelRegistry
+import numpy
+
+
+class HashingClassifier(object):
+    """
+    Logistic regression spam classifier over hashed word, word bigram and
+    character n-gram features.
+
+    Weights, followed by the bias, are stored as fixed size float32 arrays
+    in .npy files versioned by a ModelRegistry at path. The current version
+    is memory mapped read-only, so all processes on a host share a single
+    copy of the model, and scoring a text is a single sparse dot product.
+    Processes pick up new versions within reload_interval seconds. Without a
+    model every text scores 0.5.
+    """
+    def __init__(self, path, n_features=2 ** 20, char_ngram_length=3,
+                 learning_rate=0.5, alpha=1e-6, reload_interval=5,
+                 keep_versions=10, **kwargs):
+        self.registry = ModelRegistry(path, keep_versions)
+        self.n_features = n_features
+        self.char_ngram_length = char_ngram_length
+        self.learning_rate = learning_rate
+        self.alpha = alpha
+        self.reload_interval = reload_interval
+        self.load()
+
+    def load(self):
+        """
+        Memory maps the current model version, if any.
+        """
+        version = self.registry.get_current_version()
+        if version is not None:
+            weights = numpy.load(
+                self.registry.get_version_path(version),
+                mmap_mode='r'
+            )
+            self.n_features = len(weights) - 1
+            # Swapped in at once so concurrent scoring never sees a mix of
+            # versions.
+            self.weights, self.version = weights, version
+        else:
+            self.clear()
+            self.version = None
+        self.checked = time.time()
+
+    def refresh(self, force=False):
+        """
+        Loads the current model version if it has changed, checking at most
+        once every reload_interval seconds unless forced.
+        """
+        if force or time.time() - self.checked >= self.reload_interval:
+            self.checked = time.time()
+            if self.registry.get_current_version() != self.version:
+                self.load()
+
+    def store(self):
+        """
+        Stores the weights as a new model version and makes it the current
+        version. Returns the version.
+        """
+        weights = numpy.asarray(self.weights, dtype=numpy.float32)
+        self.version = self.registry.publish(
+            lambda f: numpy.save(f, weights)
+        )
+        return self.version
+
+    def clear(self):
+        """
+        Resets all weights to zero, in memory.
+        """
+        self.weights = numpy.zeros(self.n_features + 1, dtype=numpy.float32)
+
+    def get_features(self, text):
+        """
+        Returns a list of the tokens, token bigrams and character n-grams of
+        words in text.
+        """
+        tokens = tokenizer.tokenize(text)
+        features = ['w:%s' % token for token in tokens]
+        features.extend(
+            'b:%s' % bigram for bigram in tokenizer.ngrams(tokens, 2)
+        )
+        for token in tokens:
+            if not tokenizer.is_canonical(token):
+                features.extend(
+                    'c:%s' % ngram for ngram in
+                    tokenizer.char_ngrams(token, self.char_ngram_length)
+                )
+        return features
+
+    def vectorize(self, text):
+        """
+        Returns the indices and values of the nonzero entries of text's l2
+        normalized hashed feature vector.
+        """
+        hashes = numpy.array([
+            zlib.crc32(feature.encode('utf-8')) & 0xffffffff
+            for feature in self.get_features(text)
+        ], dtype=numpy.int64)
+        if not len(hashes):
+            return numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0)
+        # The top bit of a hash signs its feature so that collisions tend to
+        # cancel out rather than add up.
+        signs = numpy.where(hashes & 0x80000000, -1.0, 1.0)
+        indices, inverse = numpy.unique(
+            hashes % self.n_features,
+            return_inverse=True
+        )
+        values = numpy.bincount(inverse, weights=signs)
+        norm = numpy.sqrt(numpy.dot(values, values))
+        if norm:
+            values /= norm
+        return indices.astype(numpy.intp), values
+
+    def score_many(self, texts):
+        """
+        Returns an array of the probabilities that each of texts is spam.
+        """
+        self.refresh()
+        texts = list(texts)
+        rows = []
+        indices = []
+        values = []
+        for row, text in enumerate(texts):
+            text_indices, text_values = self.vectorize(text)
+            rows.append(numpy.repeat(row, len(text_indices)))
+            indices.append(text_indices)
+            values.append(text_values)
+        if not texts:
+            return numpy.zeros(0)
+        indices = numpy.concatenate(indices)
+        margins = numpy.bincount(
+            numpy.concatenate(rows).astype(numpy.intp),
+            weights=self.weights[indices] * numpy.concatenate(values),
+            minlength=len(texts)
+        ) + self.weights[-1]
+        return sigmoid(margins)
+
+    def spamprob(self, text):
+        return float(self.score_many([text])[0])
+
+    def learn(self, text, is_spam):
+        self.learn_many([(text, is_spam)])
+
+    def learn_many(self, examples):
+        """
+        Trains the classifier on a sequence of (text, is_spam) tuples with a
+        pass of stochastic gradient descent on the L2 regularized log loss.
+
+        Weights are updated in memory, call store to save them.
+        """
+        if not self.weights.flags.writeable:
+            self.weights = numpy.array(self.weights)
+        weights = self.weights
+        for text, is_spam in examples:
+            indices, values = self.vectorize(text)
+            margin = numpy.dot(weights[indices], values) + weights[-1]
+            gradient = sigmoid(margin) - float(bool(is_spam))
+            weights[indices] -= self.learning_rate * (
+                gradient * values + self.alpha * weights[indices]
+            )
+            weights[-1] -= self.learning_rate * gradient
+
+    def unlearn_many(self, examples):
+        """
+        Gradient descent updates can't be reverted, reversed decisions are
+        accounted for by learning the corrected labels instead.
+        """
+        pass
+
+
+def sigmoid(margins):
+    return 1 / (1 + numpy.exp(-numpy.clip(margins, -35, 35)))
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+
+class LRUCache(object):
+    """
+    Thread safe dictionary like cache holding at most maxsize items, evicting
+    the least recently used item when full.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Reinserting moves the item to the most recently used end.
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = self.misses = 0
+
+
+_missing = object()
+
+
+def memoize(maxsize=1000):
+    """
+    Decorator caching the results of a function of hashable positional
+    arguments in an LRUCache, available as the function's cache attribute.
+    """
+    def decorator(func):
+        cache = LRUCache(maxsize)
+
+        @wraps(func)
+        def wrapper(*args):
+            result = cache.get(args, _missing)
+            if result is _missing:
+                result = func(*args)
+                cache.set(args, result)
+            return result
+        wrapper.cache = cache
+        return wrapper
+    return decorator
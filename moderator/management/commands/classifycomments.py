@@ -1,10 +1,117 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.contrib.comments.models import Comment
-from django.db.models import Q
+from django.db import connection, transaction
+from django.db.models import Max, Min, Q
 from moderator import utils
 
+# Number of primary key ranges handed to each worker process, more ranges
+# than workers balances load when comments are unevenly spread.
+RANGES_PER_WORKER = 4
+
+
+def get_default_checkpoint():
+    """
+    Returns the checkpoint file count limited runs record progress in unless
+    given another, one per database.
+    """
+    name = hashlib.md5(str(connection.settings_dict['NAME'])).hexdigest()
+    return os.path.join(
+        tempfile.gettempdir(),
+        'moderator-classifycomments-%s.checkpoint' % name
+    )
+
+
+def get_unclassified_comments():
+    """
+    Returns comments that haven't already been classified or are classified
+    as unsure.
+    """
+    return Comment.objects.filter(
+        Q(classifiedcomment__isnull=True) |
+        Q(classifiedcomment__cls='unsure')
+    )
+
+
+def get_unclassified_comment_ids(after_pk, limit, until_pk=None):
+    """
+    Returns up to limit ids, in primary key order, of unclassified comments
+    with a primary key greater than after_pk and, if provided, not greater
+    than until_pk.
+    """
+    comments = get_unclassified_comments().filter(pk__gt=after_pk)
+    if until_pk is not None:
+        comments = comments.filter(pk__lte=until_pk)
+    return utils.get_comment_ids(comments.order_by('pk')[:limit])
+
+
+def classify_range(after_pk, chunk_size, until_pk=None, count=0,
+                   callback=None):
+    """
+    Classifies unclassified comments with a primary key greater than after_pk
+    and not greater than until_pk, one committed chunk at a time. callback, if
+    provided, is called with the last classified primary key and running total
+    after each chunk.
+
+    Returns a (total, counts, finished) tuple where finished indicates that no
+    comments are left to classify in the range.
+    """
+    total = 0
+    counts = {}
+    while not count or total < count:
+        limit = chunk_size
+        if count:
+            limit = min(chunk_size, count - total)
+        comment_ids = get_unclassified_comment_ids(after_pk, limit, until_pk)
+        if not comment_ids:
+            return total, counts, True
+
+        with transaction.commit_on_success():
+            chunk_counts = utils.classify_comments(comment_ids)
+
+        after_pk = max(comment_ids)
+        total += len(comment_ids)
+        for cls, cls_count in chunk_counts.items():
+            counts[cls] = counts.get(cls, 0) + cls_count
+        if callback:
+            callback(after_pk, total)
+    return total, counts, False
+
+
+def split_range(after_pk, until_pk, count):
+    """
+    Splits the primary keys greater than after_pk and not greater than
+    until_pk into roughly count contiguous (after_pk, until_pk) ranges.
+    """
+    step = max((until_pk - after_pk) // count, 1)
+    ranges = []
+    while after_pk < until_pk:
+        ranges.append((after_pk, min(after_pk + step, until_pk)))
+        after_pk = ranges[-1][1]
+    return ranges
+
+
+def classify_range_worker(args):
+    """
+    Worker process entry point. Closes the connection inherited from the
+    parent process so each worker opens its own.
+    """
+    after_pk, until_pk, chunk_size = args
+    connection.close()
+    total, counts, finished = classify_range(
+        after_pk,
+        chunk_size,
+        until_pk=until_pk
+    )
+    connection.close()
+    return total, counts
+
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -13,6 +120,26 @@ class Command(BaseCommand):
                     type="int",
                     default=0,
                     help='Number of comments to classify.'),
+        make_option('-s', '--chunk-size',
+                    dest='chunk_size',
+                    type="int",
+                    default=1000,
+                    help='Number of comments to classify and commit at a '
+                         'time.'),
+        make_option('--checkpoint',
+                    dest='checkpoint',
+                    default=None,
+                    help='File in which to record progress. An interrupted '
+                         'run resumes from this file, which is removed once '
+                         'all comments have been classified. Runs limited by '
+                         '--count record progress in a temporary file by '
+                         'default.'),
+        make_option('-w', '--workers',
+                    dest='workers',
+                    type="int",
+                    default=1,
+                    help='Number of processes to classify with in parallel, '
+                         'each handling separate primary key ranges.'),
     )
     help = 'Classifies comments as either spam or '\
            'ham using Bayesian inference and user reports.'
@@ -21,23 +148,128 @@ class Command(BaseCommand):
         """
         Collect all comments that hasn't already been
         classified or are classified as unsure.
-        Order randomly so we don't rehash previously unsure classifieds
-        when count limiting.
+        Comments are walked in primary key order in chunks so memory use is
+        bounded and an interrupted run can resume after the last committed
+        chunk.
+        """
+        start = time.time()
+        if options['workers'] > 1:
+            if options['count'] or options['checkpoint']:
+                raise CommandError(
+                    '--count and --checkpoint can not be used with --workers.'
+                )
+            total, counts = self.handle_parallel(
+                options['workers'],
+                options['chunk_size'],
+                start
+            )
+        else:
+            checkpoint = options['checkpoint']
+            if options['count'] and not checkpoint:
+                # Pick up where the previous run stopped rather than
+                # classifying the same unsure comments on every run.
+                checkpoint = get_default_checkpoint()
+            total, counts = self.handle_serial(
+                options['count'],
+                options['chunk_size'],
+                checkpoint,
+                start
+            )
+
+        self.stdout.write('Classified %s comments in %.1f seconds.\n' % (
+            total,
+            time.time() - start
+        ))
+        for cls, cls_count in sorted(counts.items()):
+            self.stdout.write('%s: %s\n' % (cls, cls_count))
+        self.stdout.write('Done!\n')
+
+    def handle_serial(self, count, chunk_size, checkpoint, start):
+        last_pk = self.read_checkpoint(checkpoint)
+        if last_pk:
+            self.stdout.write('Resuming after comment %s.\n' % last_pk)
+
+        def callback(last_pk, total):
+            self.write_checkpoint(checkpoint, last_pk)
+            self.write_progress(total, start)
+
+        total, counts, finished = classify_range(
+            last_pk,
+            chunk_size,
+            count=count,
+            callback=callback
+        )
+        # Everything has been classified, so there is nothing left to resume.
+        if finished and checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return total, counts
+
+    def handle_parallel(self, workers, chunk_size, start):
         """
-        comments = Comment.objects.filter(
-            Q(classifiedcomment__isnull=True) |
-            Q(classifiedcomment__cls='unsure')).order_by('?')
-        if options['count']:
-            comments = comments[:options['count']]
-        comment_count = comments.count()
-
-        self.stdout.write('Classifying %s comments, please wait...' %
-                          comment_count)
+        Splits the unclassified primary key space into ranges classified by a
+        pool of worker processes, merging their results.
+        """
+        bounds = get_unclassified_comments().aggregate(
+            min_pk=Min('pk'),
+            max_pk=Max('pk')
+        )
+        if bounds['min_pk'] is None:
+            return 0, {}
+
+        ranges = [
+            (after_pk, until_pk, chunk_size) for after_pk, until_pk in
+            split_range(
+                bounds['min_pk'] - 1,
+                bounds['max_pk'],
+                workers * RANGES_PER_WORKER
+            )
+        ]
+
+        self.stdout.write('Classifying %s ranges with %s workers.\n' % (
+            len(ranges),
+            workers
+        ))
+        # Forked workers must not share the parent's connection.
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        total = 0
+        counts = {}
+        try:
+            for range_total, range_counts in pool.imap_unordered(
+                    classify_range_worker, ranges):
+                total += range_total
+                for cls, cls_count in range_counts.items():
+                    counts[cls] = counts.get(cls, 0) + cls_count
+                self.write_progress(total, start)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return total, counts
+
+    def write_progress(self, total, start):
+        self.stdout.write('Classified %s comments, %.1f comments/sec.\n' % (
+            total,
+            total / max(time.time() - start, 0.001)
+        ))
         self.stdout.flush()
 
-        for comment in comments:
-            classified_comment = utils.classify_comment(comment)
-            self.stdout.write('%s,' % classified_comment.cls[0])
-            self.stdout.flush()
+    def read_checkpoint(self, checkpoint):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as f:
+            return int(f.read().strip() or 0)
 
-        self.stdout.write('\nDone!\n')
+    def write_checkpoint(self, checkpoint, last_pk):
+        """
+        Atomically replaces the checkpoint so an interruption never leaves a
+        partially written file behind.
+        """
+        if not checkpoint:
+            return
+        tmp = '%s.tmp' % checkpoint
+        with open(tmp, 'w') as f:
+            f.write('%s' % last_pk)
+        os.rename(tmp, checkpoint)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.contrib.comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Count
+from moderator.utils import BULK_CHUNK_SIZE, get_abuse_counter
+from secretballot.models import Vote
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds comment abuse counts from abuse report votes.'
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        """
+        Replaces all abuse counts with counts aggregated from negative comment
+        votes, within a single transaction when counts are stored in the
+        database.
+        """
+        counter = get_abuse_counter()
+        counter.clear()
+        reports = Vote.objects.filter(
+            content_type=ContentType.objects.get_for_model(Comment),
+            vote=-1
+        ).order_by().values('object_id').annotate(
+            report_count=Count('id')
+        ).values_list('object_id', 'report_count')
+
+        total = 0
+        chunk = []
+        for report in reports.iterator():
+            chunk.append(report)
+            if len(chunk) == BULK_CHUNK_SIZE:
+                total += self.set_counts(counter, chunk)
+                chunk = []
+        total += self.set_counts(counter, chunk)
+
+        self.stdout.write('Reconciled abuse counts for %s comments.\n' % total)
+
+    def set_counts(self, counter, reports):
+        """
+        Sets counts for those reports whose comments still exist.
+        """
+        if not reports:
+            return 0
+        comment_ids = set(Comment.objects.filter(
+            pk__in=[object_id for object_id, report_count in reports]
+        ).values_list('pk', flat=True))
+        counts = dict(
+            (object_id, report_count)
+            for object_id, report_count in reports
+            if object_id in comment_ids
+        )
+        counter.set_many(counts)
+        return len(counts)
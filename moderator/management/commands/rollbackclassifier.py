@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from moderator import utils
+
+
+class Command(BaseCommand):
+    args = '[version]'
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--list',
+                    action='store_true',
+                    dest='list',
+                    default=False,
+                    help='List stored model versions.'),
+    )
+    help = 'Makes a previously stored CLASSIFIER model version current, by '\
+           'default the version preceding the current version.'
+
+    def handle(self, *args, **options):
+        """
+        Workers pick up the change as they next check for new versions.
+        """
+        path = utils.get_setting('CLASSIFIER')
+        if path is None:
+            raise CommandError('No CLASSIFIER is configured.')
+        classifier = utils.load_class(path)(
+            **utils.get_setting('CLASSIFIER_CONFIG')
+        )
+        registry = getattr(classifier, 'registry', None)
+        if registry is None:
+            raise CommandError('%s models are not versioned.' % path)
+
+        versions = registry.get_versions()
+        current_version = registry.get_current_version()
+        if options['list']:
+            for version in versions:
+                self.stdout.write('%s%s\n' % (
+                    version,
+                    ' (current)' if version == current_version else ''
+                ))
+            return
+
+        if args:
+            version = args[0]
+            if version not in versions:
+                raise CommandError('Unknown model version %s.' % version)
+        else:
+            previous_versions = [
+                version for version in versions
+                if current_version is None or version < current_version
+            ]
+            if not previous_versions:
+                raise CommandError('No previous model version to roll back '
+                                   'to.')
+            version = previous_versions[-1]
+
+        registry.activate(version)
+        self.stdout.write('Rolled back from model version %s to %s.\n' % (
+            current_version,
+            version
+        ))
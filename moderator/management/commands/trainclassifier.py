@@ -0,0 +1,133 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from moderator import utils
+from moderator.models import ClassifiedComment
+
+
+def get_training_classifications():
+    """
+    Returns the classifications of comments classified as spam or ham by
+    moderators.
+    """
+    return ClassifiedComment.objects.filter(
+        cls__in=utils.MODERATED_CLASSES,
+        moderated=True
+    )
+
+
+def get_training_examples(after_pk, limit):
+    """
+    Returns up to limit (pk, text, is_spam) tuples, in primary key order, of
+    comments classified as spam or ham by moderators with a classification
+    primary key greater than after_pk.
+    """
+    classified_comments = get_training_classifications().filter(
+        pk__gt=after_pk
+    ).order_by('pk').values_list('pk', 'comment__comment', 'cls')
+    return [
+        (pk, text or '', cls == 'spam')
+        for pk, text, cls in classified_comments[:limit]
+    ]
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--chunk-size',
+                    dest='chunk_size',
+                    type="int",
+                    default=1000,
+                    help='Number of comments to train on at a time.'),
+        make_option('--reset',
+                    action='store_true',
+                    dest='reset',
+                    default=False,
+                    help='Discard the existing model and train from '
+                         'scratch. Required for classifiers counting the '
+                         'comments they are trained on.'),
+    )
+    help = 'Trains the CLASSIFIER on comments classified as spam or ham '\
+           'by moderators.'
+
+    def handle(self, *args, **options):
+        """
+        Labelled comments are streamed in primary key order in chunks,
+        updating the model incrementally, so memory use is bounded
+        regardless of the number of comments.
+        """
+        path = utils.get_setting('CLASSIFIER')
+        if path is None:
+            raise CommandError('No CLASSIFIER is configured.')
+        classifier = utils.load_class(path)(
+            **utils.get_setting('CLASSIFIER_CONFIG')
+        )
+        if getattr(classifier, 'counts_examples', False) and \
+                not options['reset']:
+            raise CommandError(
+                '%s counts the comments it is trained on, training it again '
+                'without --reset would count them twice.' % path
+            )
+        target = classifier
+        if options['reset']:
+            if hasattr(classifier, 'get_staging_classifier'):
+                # Train a staging copy, leaving the current model to score
+                # comments in the meantime.
+                target = classifier.get_staging_classifier()
+            else:
+                classifier.clear()
+
+        start = time.time()
+        after_pk = 0
+        total = spam_count = 0
+        while True:
+            examples = get_training_examples(after_pk, options['chunk_size'])
+            if not examples:
+                break
+            target.learn_many(
+                [(text, is_spam) for pk, text, is_spam in examples]
+            )
+            after_pk = examples[-1][0]
+            total += len(examples)
+            spam_count += sum(1 for example in examples if example[2])
+            self.write_progress(total, start)
+
+        version = target.store()
+        if target is not classifier:
+            classifier.replace(target)
+        self.record_trained_classes(after_pk, options['reset'])
+        self.stdout.write(
+            'Trained on %s comments (%s spam, %s ham) in %.1f seconds.\n' % (
+                total,
+                spam_count,
+                total - spam_count,
+                time.time() - start
+            )
+        )
+        if version is not None:
+            self.stdout.write('Stored model version %s.\n' % version)
+        self.stdout.write('Done!\n')
+
+    def record_trained_classes(self, last_pk, reset):
+        """
+        Records what the model has been trained on comments up to the
+        classification primary key last_pk as, so online training only
+        unlearns decisions the model was trained on.
+        """
+        if reset:
+            ClassifiedComment.objects.exclude(trained_cls=None).exclude(
+                pk__lte=last_pk,
+                cls__in=utils.MODERATED_CLASSES,
+                moderated=True
+            ).update(trained_cls=None)
+        get_training_classifications().filter(pk__lte=last_pk).update(
+            trained_cls=F('cls')
+        )
+
+    def write_progress(self, total, start):
+        self.stdout.write('Trained on %s comments, %.1f comments/sec.\n' % (
+            total,
+            total / max(time.time() - start, 0.001)
+        ))
+        self.stdout.flush()
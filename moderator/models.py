@@ -1,18 +1,47 @@
 from datetime import timedelta
+import re
+import threading
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.comments.models import Comment
-from django.db import models
-from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.signals import request_finished, request_started
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, \
+    pre_delete, pre_save
 from django.dispatch import receiver
-from moderator.constants import CLASS_CHOICES
-from likes.signals import object_liked
+from moderator.constants import CLASS_CHOICES, RULE_CLASS_CHOICES
+from secretballot.models import Vote
 import secretballot
 
 
 COMMENT_MAX_LENGTH = getattr(settings, 'COMMENT_MAX_LENGTH', 3000)
 
 
+class BlockedPhrase(models.Model):
+    """
+    Phrase or URL comments are classified as cls for containing, by the
+    moderator.rules.blocklist_stage classification stage.
+    """
+    phrase = models.CharField(
+        max_length=255,
+        unique=True,
+        help_text='Matched regardless of case, spacing and punctuation. '
+                  'Enter domains as URLs, e.g. http://example.com.'
+    )
+    cls = models.CharField(
+        'Class',
+        max_length=64,
+        choices=RULE_CLASS_CHOICES,
+        default='spam'
+    )
+
+    def __unicode__(self):
+        return self.phrase
+
+
 class CannedReply(models.Model):
     comment = models.TextField(max_length=COMMENT_MAX_LENGTH)
     site = models.ForeignKey(
@@ -29,20 +58,109 @@ class CannedReply(models.Model):
 
 
 class ClassifiedComment(models.Model):
-    comment = models.ForeignKey('comments.Comment')
+    comment = models.OneToOneField('comments.Comment')
     cls = models.CharField(
         'Class',
         max_length=64,
         choices=CLASS_CHOICES
     )
+    moderated = models.BooleanField(
+        default=False,
+        help_text='Whether the class was set by a moderator rather than '
+                  'automatically.'
+    )
+    # Fields denormalized from comment, kept in sync by signal handlers below,
+    # so moderation queues can be filtered and ordered using indexes on
+    # (cls, is_removed, staff_authored, submit_date) and
+    # (cls, staff_authored, submit_date) created by migration 0014.
+    submit_date = models.DateTimeField(
+        blank=True,
+        null=True
+    )
+    is_removed = models.BooleanField(default=False)
+    site = models.ForeignKey(
+        'sites.Site',
+        blank=True,
+        null=True
+    )
+    staff_authored = models.BooleanField(
+        default=False,
+        help_text='Whether the comment was made by a staff user, which '
+                  'includes moderator replies.'
+    )
+    # First comment of the cluster of near-duplicates the comment belongs
+    # to, if CLUSTERING is set.
+    cluster = models.ForeignKey(
+        'comments.Comment',
+        blank=True,
+        null=True,
+        related_name='clustered_comments',
+        on_delete=models.SET_NULL
+    )
+    # Class the CLASSIFIER was last trained on the comment as, so only
+    # decisions it was actually trained on are unlearned once reversed.
+    trained_cls = models.CharField(
+        max_length=64,
+        choices=CLASS_CHOICES,
+        blank=True,
+        null=True,
+        editable=False
+    )
 
     class Meta:
-        ordering = ['-comment__submit_date', ]
+        ordering = ['-submit_date', ]
 
     def __unicode__(self):
         return self.cls.title()
 
 
+class ClusterBand(models.Model):
+    """
+    Bucket a band of comments' MinHash signatures hashed into, mapped to the
+    cluster of the first comment to land in it. See moderator.clustering.
+    """
+    band = models.PositiveSmallIntegerField()
+    bucket = models.BigIntegerField()
+    cluster = models.ForeignKey(
+        'comments.Comment',
+        related_name='+'
+    )
+
+    class Meta:
+        unique_together = (('bucket', 'band'), )
+
+    def __unicode__(self):
+        return u'%s:%s' % (self.band, self.bucket)
+
+
+class CommentAbuseCount(models.Model):
+    """
+    Number of abuse reports (negative votes) a comment has received, kept up
+    to date as votes are saved so abuse checks don't have to count votes.
+    """
+    comment = models.OneToOneField(
+        'comments.Comment',
+        primary_key=True
+    )
+    count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return unicode(self.count)
+
+
+class DomainReputation(models.Model):
+    """
+    Number of comments linking to a domain moderators have marked as spam
+    and ham. See moderator.domains.
+    """
+    domain = models.CharField(max_length=255, unique=True)
+    spam_count = models.IntegerField(default=0)
+    ham_count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return self.domain
+
+
 class CommentReply(models.Model):
     user = models.ForeignKey(
         'auth.User',
@@ -92,6 +210,51 @@ class CommentReply(models.Model):
             return self.comment
 
 
+class RegexRule(models.Model):
+    """
+    Regular expression comments are classified as cls for matching, by the
+    moderator.rules.regex_stage classification stage.
+    """
+    name = models.CharField(max_length=100)
+    pattern = models.TextField(
+        help_text='Python regular expression, matched case insensitively. '
+                  'Named groups and backreferences are not supported.'
+    )
+    cls = models.CharField(
+        'Class',
+        max_length=64,
+        choices=RULE_CLASS_CHOICES,
+        default='spam'
+    )
+    is_active = models.BooleanField(default=True)
+
+    def __unicode__(self):
+        return self.name
+
+    def clean(self):
+        try:
+            compiled = re.compile(self.pattern)
+        except re.error as e:
+            raise ValidationError({'pattern': ['Invalid pattern: %s' % e]})
+        if compiled.groupindex:
+            raise ValidationError({
+                'pattern': ['Named groups are not supported.']
+            })
+        if compiled.match(''):
+            raise ValidationError({
+                'pattern': ['Patterns must not match empty text.']
+            })
+        from moderator.rules import has_backreferences, has_inline_flags
+        if has_backreferences(self.pattern):
+            raise ValidationError({
+                'pattern': ['Backreferences are not supported.']
+            })
+        if has_inline_flags(self.pattern):
+            raise ValidationError({
+                'pattern': ['Inline flags are not supported.']
+            })
+
+
 # Proxy models for admin display.
 class HamComment(Comment):
     class Meta:
@@ -124,47 +287,202 @@ def comment_reply_pre_delete_handler(sender, instance, **kwargs):
 @receiver(m2m_changed, sender=CommentReply.replied_to_comments.through)
 def comment_reply_post_create_handler(sender, instance, action, model, pk_set,
     using, **kwargs):
+    """
+    Creates, or updates the text of, a reply comment for every comment
+    replied to. Reply comments are looked up, created and attached in
+    batches rather than one comment at a time.
+    """
     if action == 'post_add':
-        for replied_to_comment in instance.replied_to_comments.all():
-            moderator_settings = getattr(settings, 'MODERATOR', None)
-            offset_timedelta = timedelta(seconds=1)
-            if moderator_settings:
-                if 'REPLY_BEFORE_COMMENT' in moderator_settings:
-                    if moderator_settings['REPLY_BEFORE_COMMENT']:
-                        offset_timedelta = timedelta(seconds=-1)
-
-            created = False
-            # We use try except DoesNotExist instead of get or create to
-            # allow us to add a is_reply_comment to a newly created comment
-            # which facilitates realtime_comment_classifier below to distinguish
-            # between normal comments and reply comments.
-            try:
-                comment_obj = Comment.objects.get(
-                    content_type=replied_to_comment.content_type,
-                    object_pk=replied_to_comment.object_pk,
-                    site=replied_to_comment.site,
-                    submit_date=replied_to_comment.submit_date + offset_timedelta,
-                    user=instance.user,
+        from moderator.utils import BULK_CHUNK_SIZE, bulk_create, \
+            get_setting
+        offset_timedelta = timedelta(seconds=1)
+        if get_setting('REPLY_BEFORE_COMMENT'):
+            offset_timedelta = timedelta(seconds=-1)
+
+        comment_text = instance.comment_text
+        replied_to_comments = list(instance.replied_to_comments.all())
+        for offset in range(0, len(replied_to_comments), BULK_CHUNK_SIZE):
+            chunk = replied_to_comments[offset:offset + BULK_CHUNK_SIZE]
+            reply_comments = dict(
+                ((
+                    replied_to_comment.content_type_id,
+                    replied_to_comment.object_pk,
+                    replied_to_comment.site_id,
+                    replied_to_comment.submit_date + offset_timedelta,
+                ), None) for replied_to_comment in chunk
+            )
+            reply_comments.update(
+                get_reply_comment_ids(reply_comments.keys(), instance.user)
+            )
+
+            existing_ids = [pk for pk in reply_comments.values() if pk]
+            if existing_ids:
+                Comment.objects.filter(pk__in=existing_ids).update(
+                    comment=comment_text
                 )
-            except Comment.DoesNotExist:
-                comment_obj = Comment(
-                    content_type=replied_to_comment.content_type,
-                    object_pk=replied_to_comment.object_pk,
-                    site=replied_to_comment.site,
-                    submit_date=replied_to_comment.submit_date + offset_timedelta,
-                    user=instance.user,
-                    comment=instance.comment_text,
+
+            new_comments = []
+            for key, pk in reply_comments.items():
+                if pk is None:
+                    content_type_id, object_pk, site_id, submit_date = key
+                    comment_obj = Comment(
+                        content_type_id=content_type_id,
+                        object_pk=object_pk,
+                        site_id=site_id,
+                        submit_date=submit_date,
+                        user=instance.user,
+                        comment=comment_text,
+                    )
+                    # Reply comments are never classified. bulk_create
+                    # doesn't send post_save so realtime_comment_classifier
+                    # won't see these, but flag them as replies regardless.
+                    comment_obj.is_reply_comment = True
+                    new_comments.append(comment_obj)
+            if new_comments:
+                bulk_create(Comment, new_comments)
+                reply_comments.update(get_reply_comment_ids(
+                    [key for key, pk in reply_comments.items() if pk is None],
+                    instance.user
+                ))
+
+            # add only inserts those comments not already attached, binding
+            # two parameters per through table row.
+            reply_comment_ids = list(reply_comments.values())
+            batch_size = BULK_CHUNK_SIZE // 2
+            for batch in range(0, len(reply_comment_ids), batch_size):
+                instance.reply_comments.add(
+                    *reply_comment_ids[batch:batch + batch_size]
                 )
-                comment_obj.is_reply_comment = True
-                comment_obj.save()
-                created = True
 
-            if not created:
-                comment_obj.comment = instance.comment_text
-                comment_obj.save()
 
-            if comment_obj not in instance.reply_comments.all():
-                instance.reply_comments.add(comment_obj)
+def get_reply_comment_ids(keys, user):
+    """
+    Returns a dictionary mapping (content_type_id, object_pk, site_id,
+    submit_date) keys to the ids of reply comments by user matching them,
+    using a single query.
+    """
+    keys = set(keys)
+    reply_comment_ids = {}
+    if not keys:
+        return reply_comment_ids
+    reply_comments = Comment.objects.filter(
+        user=user,
+        submit_date__in=set(key[3] for key in keys)
+    ).values_list('pk', 'content_type_id', 'object_pk', 'site_id',
+                  'submit_date')
+    for pk, content_type_id, object_pk, site_id, submit_date in \
+            reply_comments:
+        key = (content_type_id, object_pk, site_id, submit_date)
+        if key in keys:
+            reply_comment_ids[key] = pk
+    return reply_comment_ids
+
+
+# Whether a request is in progress and the keys of rule set versions changed
+# within its managed transactions, per thread, changed again once the
+# request is finished and its transactions committed.
+pending_versions = threading.local()
+
+
+def update_rules_version(key):
+    """
+    Changes the version of a set of rules so processes recompile them.
+
+    Within a request's managed transaction processes recompiling before the
+    transaction is committed would compile the previous rules under the new
+    version, so the version is only changed once the request is finished.
+    """
+    if transaction.is_managed() and \
+            getattr(pending_versions, 'in_request', False):
+        pending_versions.keys.add(key)
+    else:
+        from moderator.rules import update_version
+        update_version(key)
+
+
+@receiver(request_started)
+def request_started_versions_handler(sender, **kwargs):
+    pending_versions.in_request = True
+    pending_versions.keys = set()
+
+
+@receiver(request_finished)
+def pending_versions_handler(sender, **kwargs):
+    """
+    Changes the versions of rule sets changed during the request.
+    """
+    keys = getattr(pending_versions, 'keys', None)
+    pending_versions.in_request = False
+    pending_versions.keys = set()
+    if keys:
+        from moderator.rules import update_version
+        for key in keys:
+            update_version(key)
+
+
+@receiver(post_delete, sender=BlockedPhrase)
+@receiver(post_save, sender=BlockedPhrase)
+def blocklist_version_handler(sender, instance, **kwargs):
+    """
+    Changes the blocklist version so processes recompile the blocklist.
+    """
+    from moderator.rules import BLOCKLIST_VERSION_KEY
+    update_rules_version(BLOCKLIST_VERSION_KEY)
+
+
+@receiver(post_delete, sender=RegexRule)
+@receiver(post_save, sender=RegexRule)
+def regex_rules_version_handler(sender, instance, **kwargs):
+    """
+    Changes the regex rule set version so processes recompile the rules.
+    """
+    from moderator.rules import REGEX_RULES_VERSION_KEY
+    update_rules_version(REGEX_RULES_VERSION_KEY)
+
+
+@receiver(post_save, sender=Comment)
+def classified_comment_sync_handler(sender, instance, created, **kwargs):
+    """
+    Keeps fields denormalized onto a comment's classification in sync.
+    """
+    if not created:
+        ClassifiedComment.objects.filter(comment=instance).update(
+            submit_date=instance.submit_date,
+            is_removed=instance.is_removed,
+            site=instance.site_id,
+            staff_authored=bool(instance.user_id and instance.user.is_staff),
+        )
+
+
+@receiver(pre_save, sender=User)
+def classified_comment_staff_pre_save_handler(sender, instance, **kwargs):
+    """
+    Records the previous staff status of changed users so that their
+    classified comments are only updated when it changes, rather than on
+    every save such as on login.
+    """
+    if instance.pk:
+        previous_is_staff = User.objects.filter(
+            pk=instance.pk
+        ).values_list('is_staff', flat=True)
+        instance.previous_is_staff = previous_is_staff[0] \
+            if previous_is_staff else None
+
+
+@receiver(post_save, sender=User)
+def classified_comment_staff_sync_handler(sender, instance, created,
+    **kwargs):
+    """
+    Keeps the staff_authored flag of a user's classified comments in sync
+    with the user's staff status.
+    """
+    previous_is_staff = getattr(instance, 'previous_is_staff', None)
+    if not created and previous_is_staff is not None and \
+            previous_is_staff != instance.is_staff:
+        ClassifiedComment.objects.filter(comment__user=instance).exclude(
+            staff_authored=instance.is_staff
+        ).update(staff_authored=instance.is_staff)
+    instance.previous_is_staff = instance.is_staff
 
 
 @receiver(post_save, sender=Comment)
@@ -174,6 +492,10 @@ def realtime_comment_classifier(sender, instance, created, **kwargs):
 
     This behaviour is configurable by the REALTIME_CLASSIFICATION MODERATOR,
     default behaviour is to classify(True).
+
+    If ASYNC_CLASSIFICATION is set comments are instead queued for
+    classification by a Celery task, keeping classification writes out of
+    the request posting the comment.
     """
     # Only classify if newly created.
     if created:
@@ -185,16 +507,124 @@ def realtime_comment_classifier(sender, instance, created, **kwargs):
 
         # Only classify if not a reply comment.
         if not getattr(instance, 'is_reply_comment', False):
-            from moderator.utils import classify_comment
-            classify_comment(instance)
+            from moderator.utils import classify_comment, get_setting
+            if not get_setting('ASYNC_CLASSIFICATION'):
+                classify_comment(instance)
+            elif transaction.is_managed() and \
+                    getattr(pending_classification, 'in_request', False):
+                # Defer queueing until the request is finished, by which time
+                # its transaction has been committed and the comment is
+                # visible to workers.
+                pending_classification.comment_ids.append(instance.pk)
+            else:
+                # Outside of requests, in tasks, commands and so on, there is
+                # no telling when managed transactions commit. Comments not
+                # yet visible to workers by then are skipped, to be
+                # classified by classifycomments.
+                queue_comments_for_classification([instance.pk])
+
+
+# Whether a request is in progress and the ids of comments created within
+# its managed transactions, per thread, awaiting the end of the request to
+# be queued for asynchronous classification.
+pending_classification = threading.local()
+
+
+@receiver(request_started)
+def request_started_classification_handler(sender, **kwargs):
+    pending_classification.in_request = True
+    pending_classification.comment_ids = []
+
+
+@receiver(request_finished)
+def pending_classification_handler(sender, **kwargs):
+    """
+    Queues comments created during the request for classification.
+
+    Comments whose creation was rolled back are queued too, the
+    classification task simply skips them.
+    """
+    comment_ids = getattr(pending_classification, 'comment_ids', None)
+    pending_classification.in_request = False
+    pending_classification.comment_ids = []
+    if comment_ids:
+        queue_comments_for_classification(comment_ids)
+
+
+def queue_comments_for_classification(comment_ids):
+    """
+    Queues newly created comments for classification by a Celery task.
+
+    If CLASSIFY_COALESCE_WINDOW is set comments are buffered and classified
+    in batches at most once per that many seconds.
+    """
+    from moderator import tasks
+    from moderator.utils import get_setting
+    window = get_setting('CLASSIFY_COALESCE_WINDOW')
+    if window:
+        tasks.new_comments_queue.add(comment_ids, window)
+    else:
+        tasks.classify_comments_task.delay(comment_ids)
 
 
-@receiver(object_liked)
-def flag_reported_comments(instance, request, **kwargs):
-    if not getattr(instance, 'is_reply_comment', False) and\
-        isinstance(instance, Comment):
-        from moderator.tasks import flag_reported_comments_task
-        flag_reported_comments_task.delay(instance)
+def is_comment_vote(vote):
+    return vote.content_type_id == \
+        ContentType.objects.get_for_model(Comment).id
+
+
+@receiver(pre_save, sender=Vote)
+def abuse_count_pre_save_handler(sender, instance, **kwargs):
+    """
+    Records the previous value of changed comment votes so that abuse counts
+    can be adjusted once saved.
+    """
+    if instance.pk and is_comment_vote(instance):
+        previous_votes = Vote.objects.filter(
+            pk=instance.pk
+        ).values_list('vote', flat=True)
+        instance.previous_vote = previous_votes[0] if previous_votes else None
+
+
+@receiver(post_save, sender=Vote)
+def abuse_count_post_save_handler(sender, instance, created, **kwargs):
+    """
+    Increments or decrements a comment's abuse count as negative votes are
+    cast or changed, flagging the comment once its count reaches
+    ABUSE_CUTOFF.
+    """
+    if is_comment_vote(instance):
+        previous_vote = getattr(instance, 'previous_vote', None)
+        amount = int(instance.vote == -1) - int(previous_vote == -1)
+        if amount:
+            from moderator.utils import get_setting, update_abuse_count
+            count = update_abuse_count(instance.object_id, amount)
+            cutoff = get_setting('ABUSE_CUTOFF')
+            if count >= cutoff > count - amount:
+                flag_reported_comments(instance.object_id)
+
+
+@receiver(post_delete, sender=Vote)
+def abuse_count_post_delete_handler(sender, instance, **kwargs):
+    if is_comment_vote(instance) and instance.vote == -1:
+        from moderator.utils import update_abuse_count
+        update_abuse_count(instance.object_id, -1)
+
+
+def flag_reported_comments(comment_id):
+    """
+    Queues a reported comment for classification. Only called as a comment's
+    abuse count crosses ABUSE_CUTOFF rather than for every report.
+
+    If FLAG_COALESCE_WINDOW is set comments are buffered and flagged in
+    batches at most once per that many seconds.
+    """
+    from moderator import tasks
+    from moderator.utils import get_setting
+    window = get_setting('FLAG_COALESCE_WINDOW')
+    if window:
+        tasks.reported_comments_queue.add([comment_id], window)
+    else:
+        tasks.flag_reported_comments_task.delay([comment_id])
 
 
 # Enable voting on Comments (for negative votes/reporting abuse).
@@ -0,0 +1,142 @@
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import timezone
+
+
+class CappedCount(int):
+    """
+    A count known to be at least its value, displayed as e.g. '10,000+'.
+    """
+    def __unicode__(self):
+        return u'{0:,}+'.format(int(self))
+
+    __str__ = __unicode__
+
+
+def get_count_cache_key(queryset):
+    """
+    Returns a cache key identifying the rows a queryset counts, ignoring
+    ordering and select_related.
+    """
+    try:
+        sql = str(queryset.order_by().values_list('pk').query)
+    except EmptyResultSet:
+        return None
+    return 'moderator:count:%s' % hashlib.md5(sql.encode('utf-8')).hexdigest()
+
+
+def cache_count(queryset, timeout):
+    """
+    Counts a queryset exactly and caches the count for CappedCountPaginator.
+    """
+    count = queryset.count()
+    key = get_count_cache_key(queryset)
+    if key:
+        cache.set(key, count, timeout)
+    return count
+
+
+class CappedCountPaginator(Paginator):
+    """
+    Paginator that avoids exact COUNT(*) queries over large querysets by
+    counting at most cap + 1 rows. Counts beyond cap are returned as a
+    CappedCount of cap.
+
+    Exact counts cached by cache_count are used when available. Exact counts
+    are also computed, and cached, when exact is True.
+    """
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, cap=10000, exact=False,
+                 timeout=300):
+        super(CappedCountPaginator, self).__init__(
+            object_list,
+            per_page,
+            orphans,
+            allow_empty_first_page
+        )
+        self.cap = cap
+        self.exact = exact
+        self.timeout = timeout
+
+    def _get_count(self):
+        if self._count is None:
+            key = get_count_cache_key(self.object_list)
+            count = cache.get(key) if key else None
+            if count is None and self.exact:
+                count = cache_count(self.object_list, self.timeout)
+            if count is None:
+                pks = self.object_list.order_by().values_list('pk', flat=True)
+                count = len(pks[:self.cap + 1])
+                if count > self.cap:
+                    count = CappedCount(self.cap)
+            self._count = count
+        return self._count
+    count = property(_get_count)
+
+    @property
+    def count_is_capped(self):
+        return isinstance(self.count, CappedCount)
+
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(date, pk):
+    """
+    Encodes a (date, pk) keyset position as a query string safe cursor.
+    """
+    if settings.USE_TZ and timezone.is_aware(date):
+        date = timezone.make_naive(date, timezone.utc)
+    return '%s-%s' % (date.strftime(CURSOR_DATE_FORMAT), pk)
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor, raising ValueError for invalid
+    cursors.
+    """
+    date, pk = cursor.split('-', 1)
+    date = datetime.strptime(date, CURSOR_DATE_FORMAT)
+    if settings.USE_TZ:
+        date = timezone.make_aware(date, timezone.utc)
+    return date, int(pk)
+
+
+def get_keyset_page(queryset, date_field, per_page, after=None, before=None):
+    """
+    Returns a page of a queryset ordered by date_field and pk, newest first,
+    using keyset (seek) pagination so any page costs the same as the first.
+
+    Pages are located relative to the position of the last object on the
+    preceding page (after) or the first object on the following page
+    (before), as decoded by decode_cursor.
+
+    Returns an (objects, has_previous, has_next) tuple.
+    """
+    if before is not None:
+        date, pk = before
+        queryset = queryset.filter(
+            Q(**{'%s__gt' % date_field: date}) |
+            Q(**{date_field: date, 'pk__gt': pk})
+        ).order_by(date_field, 'pk')
+        objects = list(queryset[:per_page + 1])
+        has_previous = len(objects) > per_page
+        objects = objects[:per_page]
+        objects.reverse()
+        return objects, has_previous, True
+
+    if after is not None:
+        date, pk = after
+        queryset = queryset.filter(
+            Q(**{'%s__lt' % date_field: date}) |
+            Q(**{date_field: date, 'pk__lt': pk})
+        )
+    queryset = queryset.order_by('-%s' % date_field, '-pk')
+    objects = list(queryset[:per_page + 1])
+    return objects[:per_page], after is not None, len(objects) > per_page
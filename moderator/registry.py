@@ -0,0 +1,89 @@
+import glob
+import os
+from datetime import datetime
+
+
+VERSION_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def is_version(version):
+    """
+    Returns whether version is named after a time in VERSION_FORMAT.
+    """
+    try:
+        datetime.strptime(version, VERSION_FORMAT)
+    except ValueError:
+        return False
+    return True
+
+
+class ModelRegistry(object):
+    """
+    Stores versioned model files alongside path, a symbolic link to the
+    current version. Switching versions atomically replaces the link, so
+    readers always see a complete model and processes using a previous
+    version keep using it until they reload.
+
+    The current version is read from the link target, a cheap check for
+    processes polling for new versions.
+    """
+    def __init__(self, path, keep_versions=10):
+        self.path = path
+        self.keep_versions = keep_versions
+
+    def get_version_path(self, version):
+        return '%s.%s' % (self.path, version)
+
+    def get_versions(self):
+        """
+        Returns a list of stored versions, oldest first. Other files sharing
+        path as a prefix, backups say, aren't versions.
+        """
+        prefix = '%s.' % self.path
+        versions = (
+            version_path[len(prefix):]
+            for version_path in glob.glob('%s*' % prefix)
+        )
+        return sorted(version for version in versions if is_version(version))
+
+    def get_current_version(self):
+        """
+        Returns the current version, or None if there is none.
+        """
+        try:
+            target = os.readlink(self.path)
+        except OSError:
+            return None
+        return os.path.basename(target)[len(os.path.basename(self.path)) + 1:]
+
+    def publish(self, write):
+        """
+        Stores a new version, named after the current time, written to a file
+        object by write, and makes it the current version. Versions beyond
+        the keep_versions most recent are removed.
+
+        Returns the new version.
+        """
+        version = datetime.utcnow().strftime(VERSION_FORMAT)
+        version_path = self.get_version_path(version)
+        tmp_path = '%s.tmp' % version_path
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, version_path)
+        self.activate(version)
+        for old_version in self.get_versions()[:-self.keep_versions]:
+            os.remove(self.get_version_path(old_version))
+        return version
+
+    def activate(self, version):
+        """
+        Atomically makes a stored version the current version.
+        """
+        version_path = self.get_version_path(version)
+        if not is_version(version) or not os.path.exists(version_path):
+            raise ValueError('Unknown model version %s.' % version)
+        tmp_path = '%s.tmp' % version_path
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(os.path.basename(version_path), tmp_path)
+        os.rename(tmp_path, self.path)
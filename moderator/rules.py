@@ -0,0 +1,247 @@
+"""
+Rule based classification stages, listed in CLASSIFICATION_STAGES to run
+ahead of the verdict cache and CLASSIFIER.
+
+A stage is a callable taking a dictionary mapping comment ids to texts and
+returning a dictionary mapping the ids of comments it matches to classes.
+"""
+import re
+import uuid
+
+from moderator import models, tokenizer, utils
+
+
+# Classes rules classify comments as, most severe first.
+RULE_CLASSES = ('spam', 'unsure')
+
+BLOCKLIST_VERSION_KEY = 'moderator:blocklist:version'
+REGEX_RULES_VERSION_KEY = 'moderator:regexrules:version'
+
+# Numbered backreferences and conditionals, which would refer to other rules'
+# groups once rules are combined, and named backreferences.
+BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+# Inline flags, which apply to the whole pattern and so to all other rules
+# once rules are combined.
+INLINE_FLAGS_RE = re.compile(r'(?<!\\)\(\?[iLmsux]+\)')
+
+# (version, Automaton) tuple of the most recently compiled blocklist.
+_blocklist = None
+# (version, pattern, classes) tuple of the most recently compiled regex rules.
+_regex_rules = None
+
+
+class Automaton(object):
+    """
+    Aho-Corasick automaton finding all occurrences of many patterns, token
+    sequences, in a sequence of tokens in a single pass, taking time linear
+    in the length of the sequence regardless of the number of patterns.
+    """
+    def __init__(self, patterns):
+        """
+        Builds the automaton from an iterable of (pattern, value) tuples,
+        values being what matches of patterns yield.
+        """
+        self.transitions = [{}]
+        self.outputs = [[]]
+        for pattern, value in patterns:
+            if not pattern:
+                continue
+            state = 0
+            for token in pattern:
+                next_state = self.transitions[state].get(token)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions.append({})
+                    self.outputs.append([])
+                    self.transitions[state][token] = next_state
+                state = next_state
+            self.outputs[state].append(value)
+
+        # Failure links point to the state of the longest proper suffix of a
+        # state's prefix that is also a prefix of some pattern, computed
+        # breadth first so shorter prefixes' links are known. States inherit
+        # the outputs of the states they fail to.
+        self.failures = [0] * len(self.transitions)
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for token, next_state in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and token not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                failure = self.transitions[failure].get(token, 0)
+                self.failures[next_state] = failure
+                self.outputs[next_state].extend(self.outputs[failure])
+                queue.append(next_state)
+
+    def __len__(self):
+        return len(self.transitions)
+
+    def find(self, tokens):
+        """
+        Returns the set of values of patterns occurring in tokens.
+        """
+        values = set()
+        state = 0
+        for token in tokens:
+            while state and token not in self.transitions[state]:
+                state = self.failures[state]
+            state = self.transitions[state].get(token, 0)
+            if self.outputs[state]:
+                values.update(self.outputs[state])
+        return values
+
+
+def get_version(key):
+    """
+    Returns the version of a set of rules held in Redis under key.
+    """
+    client = utils.get_redis_client()
+    version = client.get(key)
+    if version is None:
+        # The version was lost, rules compiled since are stale.
+        client.setnx(key, uuid.uuid4().hex)
+        version = client.get(key)
+    return version
+
+
+def update_version(key):
+    """
+    Changes the version of a set of rules, having processes recompile them.
+    """
+    utils.get_redis_client().set(key, uuid.uuid4().hex)
+
+
+def get_blocklist():
+    """
+    Returns an Automaton matching blocked phrases' normalized tokens, so
+    phrases match regardless of case, spacing, homoglyphs and so on.
+
+    The automaton is compiled once per process and blocklist version.
+    """
+    global _blocklist
+    version = get_version(BLOCKLIST_VERSION_KEY)
+    if _blocklist is None or _blocklist[0] != version:
+        _blocklist = (version, Automaton(
+            (tuple(tokenizer.tokenize(phrase)), cls)
+            for phrase, cls in models.BlockedPhrase.objects.values_list(
+                'phrase',
+                'cls'
+            )
+        ))
+    return _blocklist[1]
+
+
+def get_rule_class(classes):
+    """
+    Returns the most severe of the classes matched by rules.
+    """
+    for cls in RULE_CLASSES:
+        if cls in classes:
+            return cls
+
+
+def blocklist_stage(texts):
+    """
+    Classifies comments containing blocked phrases as the phrases' classes,
+    spam taking precedence over unsure.
+    """
+    blocklist = get_blocklist()
+    classes = {}
+    if len(blocklist) == 1:
+        return classes
+    for comment_id, text in texts.items():
+        cls = get_rule_class(blocklist.find(tokenizer.tokenize(text or '')))
+        if cls:
+            classes[comment_id] = cls
+    return classes
+
+
+def has_backreferences(pattern):
+    """
+    Returns whether pattern refers back to groups.
+    """
+    # Escaped backslashes are dropped first, \\1 being a backslash and a 1.
+    return bool(BACKREFERENCE_RE.search(pattern.replace('\\\\', '')))
+
+
+def has_inline_flags(pattern):
+    """
+    Returns whether pattern sets flags inline, such as (?x).
+    """
+    return bool(INLINE_FLAGS_RE.search(pattern.replace('\\\\', '')))
+
+
+def compile_regex_rules(rules):
+    """
+    Returns a pattern combining (id, pattern, class) regex rules as
+    alternatives in named groups, and a dictionary mapping group names to
+    classes.
+
+    The alternatives are wrapped in a lookahead so matches don't consume
+    text, finding rules matching at every position rather than only rules
+    not overlapping earlier matches. Spam rules are tried first at any
+    position.
+
+    Rules whose patterns don't compile, match empty strings, refer back to
+    groups, name groups or set inline flags are left out.
+    """
+    alternatives = []
+    classes = {}
+    rules = sorted(rules, key=lambda rule: RULE_CLASSES.index(rule[2]))
+    for rule_id, pattern, cls in rules:
+        try:
+            compiled = re.compile(pattern)
+        except re.error:
+            continue
+        if compiled.match('') or compiled.groupindex or \
+                has_backreferences(pattern) or has_inline_flags(pattern):
+            continue
+        name = 'rule_%s' % rule_id
+        alternatives.append('(?P<%s>%s)' % (name, pattern))
+        classes[name] = cls
+    if not alternatives:
+        return None, classes
+    return re.compile(
+        '(?=%s)' % '|'.join(alternatives),
+        re.IGNORECASE | re.UNICODE
+    ), classes
+
+
+def get_regex_rules():
+    """
+    Returns the pattern and classes compiled by compile_regex_rules from
+    active regex rules.
+
+    Rules are compiled once per process and rule set version.
+    """
+    global _regex_rules
+    version = get_version(REGEX_RULES_VERSION_KEY)
+    if _regex_rules is None or _regex_rules[0] != version:
+        _regex_rules = (version, ) + compile_regex_rules(
+            models.RegexRule.objects.filter(
+                is_active=True
+            ).values_list('pk', 'pattern', 'cls')
+        )
+    return _regex_rules[1:]
+
+
+def regex_stage(texts):
+    """
+    Classifies comments matching active regex rules as the rules' classes,
+    scanning each comment once with the combined pattern of all rules.
+    """
+    pattern, rule_classes = get_regex_rules()
+    classes = {}
+    if pattern is None:
+        return classes
+    for comment_id, text in texts.items():
+        text = (text or u'').translate(tokenizer.ZERO_WIDTH_CHARACTERS)
+        matched = set()
+        for match in pattern.finditer(text):
+            matched.add(rule_classes[match.lastgroup])
+            if RULE_CLASSES[0] in matched:
+                break
+        cls = get_rule_class(matched)
+        if cls:
+            classes[comment_id] = cls
+    return classes
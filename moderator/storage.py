@@ -0,0 +1,306 @@
+from collections import namedtuple
+
+from moderator import tokenizer, utils
+import numpy
+
+
+ClassifierState = namedtuple('ClassifierState', ['spam_count', 'ham_count'])
+
+
+class BaseClassifier(object):
+    """
+    Naive Bayes spam classifier combining token probabilities using Gary
+    Robinson's geometric mean method, as popularized by SpamBayes.
+
+    Subclasses store the number of spam and ham messages trained on (nspam
+    and nham) and per token spam and ham counts.
+    """
+    # Probability assumed for tokens never seen before and how strongly that
+    # assumption is weighted against the evidence for tokens seen rarely.
+    unknown_token_prob = 0.5
+    unknown_token_strength = 0.45
+    # Tokens with probabilities closer to 0.5 than this are ignored.
+    minimum_prob_strength = 0.1
+    # Words shorter or longer than these lengths are ignored.
+    minimum_token_length = 3
+    maximum_token_length = 12
+    # Training counts examples, so training on examples again counts them
+    # twice rather than refining the model.
+    counts_examples = True
+
+    def __init__(self, **kwargs):
+        state = self.get_state()
+        self.nspam = state.spam_count
+        self.nham = state.ham_count
+
+    def refresh(self, force=False):
+        """
+        Picks up changes to the model made by other processes. Counts are
+        read from storage as texts are scored, so there is nothing to do.
+        """
+        pass
+
+    def get_state(self):
+        """
+        Returns the stored ClassifierState.
+        """
+        raise NotImplementedError
+
+    def store(self):
+        """
+        Stores nspam and nham.
+        """
+        raise NotImplementedError
+
+    def get_token_counts(self, tokens):
+        """
+        Returns a dictionary mapping tokens to (spam count, ham count)
+        tuples, refreshing nspam and nham along the way. Tokens never seen
+        are omitted.
+        """
+        raise NotImplementedError
+
+    def update_counts(self, token_counts, spam_count, ham_count):
+        """
+        Adjusts stored token counts by the (spam, ham) amounts token_counts
+        maps tokens to and message counts by spam_count and ham_count,
+        updating nspam and nham.
+        """
+        raise NotImplementedError
+
+    def tokenize(self, text):
+        """
+        Returns the set of tokens in text.
+        """
+        return set(
+            token for token in tokenizer.tokenize(text)
+            if tokenizer.is_canonical(token) or
+            self.minimum_token_length <= len(token) <=
+            self.maximum_token_length
+        )
+
+    def learn(self, text, is_spam):
+        """
+        Trains the classifier on text being spam or ham.
+        """
+        self.learn_many([(text, is_spam)])
+
+    def learn_many(self, examples, amount=1):
+        """
+        Trains the classifier on a sequence of (text, is_spam) tuples,
+        storing all resulting count changes at once.
+        """
+        token_counts = {}
+        spam_count = ham_count = 0
+        for text, is_spam in examples:
+            if is_spam:
+                spam_count += amount
+            else:
+                ham_count += amount
+            for token in self.tokenize(text):
+                spam, ham = token_counts.get(token, (0, 0))
+                token_counts[token] = (
+                    spam + amount * int(bool(is_spam)),
+                    ham + amount * int(not is_spam)
+                )
+        self.update_counts(token_counts, spam_count, ham_count)
+
+    def unlearn_many(self, examples):
+        """
+        Reverts training on a sequence of (text, is_spam) tuples, i.e. when
+        moderators reverse their decisions.
+        """
+        self.learn_many(examples, amount=-1)
+
+    def token_probs(self, spam_counts, ham_counts):
+        """
+        Returns an array of the probabilities that messages containing tokens
+        seen in spam_counts spam and ham_counts ham messages are spam.
+        """
+        spam_ratios = spam_counts / float(self.nspam or 1)
+        ham_ratios = ham_counts / float(self.nham or 1)
+        ratios = spam_ratios + ham_ratios
+        probs = numpy.where(
+            ratios > 0,
+            spam_ratios / numpy.where(ratios > 0, ratios, 1),
+            self.unknown_token_prob
+        )
+        n = spam_counts + ham_counts
+        return (
+            self.unknown_token_strength * self.unknown_token_prob + n * probs
+        ) / (self.unknown_token_strength + n)
+
+    def spamprob(self, text):
+        """
+        Returns the probability, between 0 and 1, that text is spam. Texts
+        without any telling tokens score 0.5.
+        """
+        return float(self.score_many([text])[0])
+
+    def score_many(self, texts):
+        """
+        Returns an array of the probabilities that each of texts is spam,
+        looking up the counts of all tokens in the batch at once.
+
+        Texts are mapped to token ids through a vocabulary shared by the
+        batch, forming a sparse matrix in compressed row form, so token
+        probabilities are computed once per distinct token and combined per
+        text with array operations.
+        """
+        texts = list(texts)
+        if not texts:
+            return numpy.zeros(0)
+
+        vocabulary = {}
+        indptr = [0]
+        indices = []
+        for text in texts:
+            for token in self.tokenize(text):
+                indices.append(vocabulary.setdefault(token, len(vocabulary)))
+            indptr.append(len(indices))
+        tokens = sorted(vocabulary, key=vocabulary.get)
+        token_counts = self.get_token_counts(tokens)
+        counts = numpy.array(
+            [token_counts.get(token, (0, 0)) for token in tokens],
+            dtype=numpy.float64
+        ).reshape(-1, 2)
+        probs = self.token_probs(counts[:, 0], counts[:, 1])
+
+        # Expand to a (row, token id) coordinate per token occurrence, keeping
+        # only tokens telling enough to count.
+        indices = numpy.array(indices, dtype=numpy.intp)
+        rows = numpy.repeat(numpy.arange(len(texts)), numpy.diff(indptr))
+        strong = numpy.abs(probs - 0.5) >= self.minimum_prob_strength
+        mask = strong[indices]
+        rows = rows[mask]
+        indices = indices[mask]
+
+        n = numpy.bincount(rows, minlength=len(texts))
+        log_hamminess = numpy.bincount(
+            rows,
+            weights=numpy.log1p(-probs)[indices],
+            minlength=len(texts)
+        )
+        log_spamminess = numpy.bincount(
+            rows,
+            weights=numpy.log(probs)[indices],
+            minlength=len(texts)
+        )
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            spamminess = 1 - numpy.exp(log_hamminess / n)
+            hamminess = 1 - numpy.exp(log_spamminess / n)
+            total = spamminess + hamminess
+            scores = (1 + (spamminess - hamminess) / total) / 2
+        scores[(n == 0) | (total == 0)] = 0.5
+        return scores
+
+
+class RedisClassifier(BaseClassifier):
+    """
+    Stores counts in Redis hashes, spam and ham token counts in one hash each
+    and message counts in a third, so a text is scored with a single
+    pipelined round trip regardless of its number of tokens.
+    """
+    def __init__(self, prefix='moderator:classifier', **kwargs):
+        self.spam_key = '%s:spam' % prefix
+        self.ham_key = '%s:ham' % prefix
+        self.state_key = '%s:state' % prefix
+        self.prefix = prefix
+        self.redis = utils.get_redis_client()
+        super(RedisClassifier, self).__init__(**kwargs)
+        # Message counts as last read from or written to Redis.
+        self.stored_counts = (self.nspam, self.nham)
+
+    def _get_state(self, values):
+        return ClassifierState(*[int(value or 0) for value in values])
+
+    def get_state(self):
+        return self._get_state(
+            self.redis.hmget(self.state_key, 'spam_count', 'ham_count')
+        )
+
+    def store(self):
+        """
+        Stores nspam and nham if they were assigned directly. Training
+        increments stored counts as it goes, so there is nothing to store
+        afterwards, and overwriting counts would lose concurrent training.
+        """
+        values = {}
+        if self.nspam != self.stored_counts[0]:
+            values['spam_count'] = self.nspam
+        if self.nham != self.stored_counts[1]:
+            values['ham_count'] = self.nham
+        if values:
+            self.redis.hmset(self.state_key, values)
+        self.stored_counts = (self.nspam, self.nham)
+
+    def get_token_counts(self, tokens):
+        tokens = list(tokens)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.state_key, 'spam_count', 'ham_count')
+        if tokens:
+            pipe.hmget(self.spam_key, tokens)
+            pipe.hmget(self.ham_key, tokens)
+        results = pipe.execute()
+        state = self._get_state(results[0])
+        self.nspam = state.spam_count
+        self.nham = state.ham_count
+        self.stored_counts = (self.nspam, self.nham)
+        token_counts = {}
+        if tokens:
+            for token, spam, ham in zip(tokens, results[1], results[2]):
+                if spam or ham:
+                    token_counts[token] = (int(spam or 0), int(ham or 0))
+        return token_counts
+
+    def update_counts(self, token_counts, spam_count, ham_count):
+        # Increments rather than overwrites counts so concurrent training
+        # can't lose updates.
+        pipe = self.redis.pipeline(transaction=False)
+        for token, (spam, ham) in token_counts.items():
+            if spam:
+                pipe.hincrby(self.spam_key, token, spam)
+            if ham:
+                pipe.hincrby(self.ham_key, token, ham)
+        pipe.hincrby(self.state_key, 'spam_count', spam_count)
+        pipe.hincrby(self.state_key, 'ham_count', ham_count)
+        results = pipe.execute()
+        self.nspam, self.nham = results[-2:]
+        self.stored_counts = (self.nspam, self.nham)
+
+    def get_staging_classifier(self):
+        """
+        Returns an empty classifier stored under a staging prefix, to be
+        trained from scratch while this one keeps scoring, then swapped in
+        with replace.
+        """
+        staging = RedisClassifier(prefix='%s:staging' % self.prefix)
+        staging.clear()
+        return staging
+
+    def replace(self, other):
+        """
+        Atomically replaces all counts with those of other, which are moved
+        rather than copied.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        for source, target in (
+            (other.spam_key, self.spam_key),
+            (other.ham_key, self.ham_key),
+            (other.state_key, self.state_key),
+        ):
+            if self.redis.exists(source):
+                pipe.rename(source, target)
+            else:
+                pipe.delete(target)
+        pipe.execute()
+        self.nspam, self.nham = other.nspam, other.nham
+        self.stored_counts = (self.nspam, self.nham)
+
+    def clear(self):
+        """
+        Deletes all counts.
+        """
+        self.redis.delete(self.spam_key, self.ham_key, self.state_key)
+        self.nspam = self.nham = 0
+        self.stored_counts = (0, 0)
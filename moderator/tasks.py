@@ -1,24 +1,146 @@
-from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
-from moderator.constants import DEFAULT_CONFIG
-from secretballot.models import Vote
+from moderator.batching import CoalescingQueue, OrderedCoalescingQueue
 from moderator.models import ClassifiedComment
+from moderator.paginator import cache_count
+from moderator.utils import BULK_CHUNK_SIZE, classify_comments, \
+    get_classifier, get_reported_comment_ids, get_setting, \
+    record_trained_classes
 from celery.task import task
+from django.contrib.comments.models import Comment
 
 
 @task(ignore_result=True)
-def flag_reported_comments_task(comment):
-    classified_comment, created = ClassifiedComment.objects.get_or_create(
-        comment=comment
-    )
-    comment_content_type = ContentType.objects.get_for_model(comment)
-    moderator_settings = getattr(settings, 'MODERATOR', DEFAULT_CONFIG)
-    if Vote.objects.filter(
-        content_type=comment_content_type,
-        object_id=comment.id,
-        vote=-1
-    ).count() >= moderator_settings['ABUSE_CUTOFF']:
-        comment.is_removed = True
-        comment.save()
-        classified_comment.cls = 'reported'
-        classified_comment.save()
+def classify_comments_task(comment_ids):
+    """
+    Classifies those comments not yet classified, used to classify newly
+    created comments outside of the requests creating them.
+    """
+    for offset in range(0, len(comment_ids), BULK_CHUNK_SIZE):
+        classify_comments(Comment.objects.filter(
+            pk__in=comment_ids[offset:offset + BULK_CHUNK_SIZE],
+            classifiedcomment__isnull=True
+        ))
+
+
+@task(ignore_result=True)
+def flush_new_comments_task():
+    """
+    Classifies all comments buffered in new_comments_queue.
+    """
+    comment_ids = new_comments_queue.pop()
+    if comment_ids:
+        classify_comments_task(comment_ids)
+
+
+new_comments_queue = CoalescingQueue('new_comments', flush_new_comments_task)
+
+
+@task(ignore_result=True)
+def flag_reported_comments_task(comment_ids):
+    """
+    Classifies those comments reported as abusive at least ABUSE_CUTOFF times
+    as reported, and so removes them, checking all comments' abuse counts at
+    once.
+    """
+    reported_ids = get_reported_comment_ids(comment_ids)
+    if reported_ids:
+        classify_comments(sorted(reported_ids), 'reported')
+
+
+@task(ignore_result=True)
+def flush_reported_comments_task():
+    """
+    Flags all comments buffered in reported_comments_queue.
+    """
+    comment_ids = reported_comments_queue.pop()
+    if comment_ids:
+        flag_reported_comments_task(comment_ids)
+
+
+reported_comments_queue = CoalescingQueue(
+    'reported_comments',
+    flush_reported_comments_task
+)
+
+
+@task(ignore_result=True)
+def cache_changelist_counts_task():
+    """
+    Caches exact counts of the unfiltered comment admin listings for use by
+    capped changelists. Schedule periodically, i.e. with celerybeat, more
+    often than COUNT_CACHE_TIMEOUT.
+    """
+    from django.contrib import admin
+    from moderator.admin import CommentAdmin
+    for model_admin in admin.site._registry.values():
+        if isinstance(model_admin, CommentAdmin):
+            cache_count(
+                model_admin.queryset(None),
+                get_setting('COUNT_CACHE_TIMEOUT')
+            )
+
+
+@task(ignore_result=True)
+def flush_training_queue_task():
+    """
+    Trains the CLASSIFIER on all moderator decisions buffered in
+    training_queue, in chunks, then stores the resulting model.
+
+    Decisions are only unlearned if the classifier was trained on them, as
+    recorded by ClassifiedComment.trained_cls, so decisions made before
+    online training was enabled don't take counts below zero.
+    """
+    entries = training_queue.pop()
+    classifier = get_classifier()
+    if not entries or classifier is None:
+        return
+    # Train on top of the latest model, which may have been stored by
+    # another process.
+    classifier.refresh(force=True)
+    trained = {}
+    for offset in range(0, len(entries), BULK_CHUNK_SIZE):
+        chunk = [
+            (action, cls, int(comment_id)) for action, cls, comment_id in (
+                entry.split(':')
+                for entry in entries[offset:offset + BULK_CHUNK_SIZE]
+            )
+        ]
+        comment_ids = set(comment_id for action, cls, comment_id in chunk)
+        texts = dict(Comment.objects.filter(
+            pk__in=comment_ids
+        ).values_list('pk', 'comment'))
+        trained_classes = dict(ClassifiedComment.objects.filter(
+            comment__in=comment_ids
+        ).values_list('comment_id', 'trained_cls'))
+        trained_classes.update(trained)
+        examples = {'learn': [], 'unlearn': []}
+        for action, cls, comment_id in chunk:
+            if comment_id not in texts:
+                continue
+            trained_cls = trained_classes.get(comment_id)
+            if action == 'unlearn':
+                if trained_cls != cls:
+                    continue
+                trained_classes[comment_id] = trained[comment_id] = None
+            else:
+                if trained_cls == cls:
+                    continue
+                if trained_cls is not None:
+                    examples['unlearn'].append(
+                        (texts[comment_id], trained_cls == 'spam')
+                    )
+                trained_classes[comment_id] = trained[comment_id] = cls
+            examples[action].append((texts[comment_id], cls == 'spam'))
+        # Reverted decisions are unlearned before their corrections are
+        # learned.
+        if examples['unlearn']:
+            classifier.unlearn_many(examples['unlearn'])
+        if examples['learn']:
+            classifier.learn_many(examples['learn'])
+    classifier.store()
+    record_trained_classes(trained)
+
+
+training_queue = OrderedCoalescingQueue(
+    'training',
+    flush_training_queue_task
+)
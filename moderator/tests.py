@@ -1,10 +1,19 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
 from unittest import TestCase
 
-from django.contrib.auth.models import AnonymousUser
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import IntegrityError, transaction
 from django.template import Template, Context
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from likes.middleware import SecretBallotUserIpUseragentMiddleware
 from likes.views import can_vote_test, like
 from secretballot import views
@@ -62,6 +71,368 @@ class BaseClassifierTestCase(object):
         self.failUnlessEqual(state.ham_count, 100)
 
 
+class RedisClassifierTestCase(BaseClassifierTestCase, TestCase):
+    config = {}
+
+    @property
+    def classifier_class(self):
+        from moderator.storage import RedisClassifier
+        return RedisClassifier
+
+    def clear(self):
+        self.classifier.clear()
+
+    def tearDown(self):
+        self.clear()
+
+    def test_spamprob(self):
+        # Untrained classifiers can't tell.
+        self.failUnlessEqual(self.classifier.spamprob('buy cheap pills'), 0.5)
+
+        self.classifier.learn_many([
+            ('buy cheap pills now', True),
+            ('cheap pills for sale', True),
+            ('great article, thanks for writing', False),
+            ('thanks, this article was great', False),
+        ])
+        self.failUnlessEqual(self.classifier.nspam, 2)
+        self.failUnlessEqual(self.classifier.nham, 2)
+        self.failUnless(self.classifier.spamprob('CHEAP pills!') > 0.7)
+        self.failUnless(self.classifier.spamprob('Great article.') < 0.3)
+        self.failUnlessEqual(self.classifier.spamprob('unseen words'), 0.5)
+
+        # Counts are stored as they're learned.
+        state = self.classifier.get_state()
+        self.failUnlessEqual(state.spam_count, 2)
+        self.failUnlessEqual(state.ham_count, 2)
+
+    def test_score_many(self):
+        self.classifier.learn_many([
+            ('buy cheap pills now', True),
+            ('great article, thanks for writing', False),
+        ])
+        texts = ['cheap pills', 'great article', 'hello there', '']
+        scores = self.classifier.score_many(texts)
+        self.failUnlessEqual(len(scores), 4)
+        self.failUnless(scores[0] > 0.7)
+        self.failUnless(scores[1] < 0.3)
+        self.failUnlessEqual(list(scores[2:]), [0.5, 0.5])
+
+        # Batch scores should match scoring texts one at a time.
+        for text, score in zip(texts, scores):
+            self.failUnlessAlmostEqual(self.classifier.spamprob(text), score)
+        self.failUnlessEqual(len(self.classifier.score_many([])), 0)
+
+    def test_online_training(self):
+        from moderator import utils
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment='buy cheap pills now'
+        )
+        moderator_settings = dict(
+            settings.MODERATOR,
+            ONLINE_TRAINING_WINDOW=60
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            # Decisions are queued and, with tasks run eagerly by the test
+            # settings, trained on immediately.
+            utils.classify_comments([comment], 'spam')
+            state = self.classifier.get_state()
+            self.failUnlessEqual((state.spam_count, state.ham_count), (1, 0))
+            self.failUnless(self.classifier.spamprob('cheap pills') > 0.5)
+
+            # Repeated decisions aren't trained on again.
+            utils.classify_comments([comment], 'spam')
+            state = self.classifier.get_state()
+            self.failUnlessEqual((state.spam_count, state.ham_count), (1, 0))
+
+            # Reversed decisions replace the previous decision.
+            utils.classify_comments([comment], 'ham')
+            state = self.classifier.get_state()
+            self.failUnlessEqual((state.spam_count, state.ham_count), (0, 1))
+            self.failUnless(self.classifier.spamprob('cheap pills') < 0.5)
+
+    def test_online_unlearning(self):
+        from moderator import utils
+        from moderator.models import ClassifiedComment
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment='buy cheap pills now'
+        )
+        # Decisions made before online training was enabled were never
+        # trained on, so aren't unlearned once reversed.
+        utils.classify_comments([comment], 'spam')
+        moderator_settings = dict(
+            settings.MODERATOR,
+            ONLINE_TRAINING_WINDOW=60
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            utils.classify_comments([comment], 'ham')
+            state = self.classifier.get_state()
+            self.failUnlessEqual((state.spam_count, state.ham_count), (0, 1))
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).trained_cls,
+                'ham'
+            )
+
+            # Decisions replaced by reports are unlearned.
+            utils.classify_comments([comment], 'reported')
+            state = self.classifier.get_state()
+            self.failUnlessEqual((state.spam_count, state.ham_count), (0, 0))
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).trained_cls,
+                None
+            )
+
+    def test_train_command(self):
+        from django.core.management.base import CommandError
+        from moderator import utils
+        from moderator.management.commands.trainclassifier import Command
+        from moderator.models import ClassifiedComment
+        # Only train on this test's decisions, not those left by others.
+        ClassifiedComment.objects.filter(moderated=True).update(
+            moderated=False
+        )
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment=text
+            ) for text in ['buy cheap pills now', 'great article']
+        ]
+        utils.classify_comments(comments[:1], 'spam')
+        utils.classify_comments(comments[1:], 'ham')
+
+        # Counts would be doubled by training again without resetting.
+        self.failUnlessRaises(
+            CommandError,
+            Command().handle,
+            chunk_size=1000,
+            reset=False
+        )
+        for i in range(2):
+            call_command('trainclassifier', reset=True, stdout=StringIO())
+            state = self.classifier.get_state()
+            self.failUnlessEqual((state.spam_count, state.ham_count), (1, 1))
+        self.failUnless(self.classifier.spamprob('cheap pills') > 0.5)
+        self.failIf(self.classifier.redis.keys('moderator:classifier:staging*'))
+        # Trained decisions are recorded for online training to unlearn.
+        self.failUnlessEqual(
+            list(ClassifiedComment.objects.filter(
+                comment__in=comments
+            ).order_by('comment').values_list('trained_cls', flat=True)),
+            ['spam', 'ham']
+        )
+
+    def test_store_after_training(self):
+        # Storing after training doesn't overwrite counts incremented by
+        # other processes in the meantime.
+        other = self.classifier_class(**self.config['CLASSIFIER_CONFIG'])
+        self.classifier.learn('buy cheap pills now', True)
+        other.learn('great article', False)
+        self.classifier.store()
+        state = self.classifier.get_state()
+        self.failUnlessEqual((state.spam_count, state.ham_count), (1, 1))
+
+    def test_classify_comments(self):
+        from moderator import utils
+        self.classifier.learn_many([
+            ('buy cheap pills now', True),
+            ('great article, thanks for writing', False),
+        ])
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment=text
+            ) for text in ['cheap pills', 'great article', 'hello there']
+        ]
+        self.failUnlessEqual(
+            [utils.classify_comment(comment).cls for comment in comments],
+            ['spam', 'ham', 'unsure']
+        )
+        self.failUnless(Comment.objects.get(pk=comments[0].pk).is_removed)
+
+
+class HashingClassifierTestCase(TestCase):
+    def setUp(self):
+        from moderator.linear import HashingClassifier
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'model.npy')
+        self.classifier_class = HashingClassifier
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_learn_and_store(self):
+        classifier = self.classifier_class(self.path, n_features=2 ** 12)
+        # Without a model file texts can't be told apart.
+        self.failUnlessEqual(classifier.spamprob('buy cheap pills'), 0.5)
+
+        examples = [
+            ('buy cheap pills now', True),
+            ('great article, thanks for writing', False),
+        ]
+        for i in range(0, 20):
+            classifier.learn_many(examples)
+        classifier.store()
+
+        # Stored models are memory mapped read-only.
+        classifier = self.classifier_class(self.path)
+        self.failUnlessEqual(classifier.n_features, 2 ** 12)
+        self.failIf(classifier.weights.flags.writeable)
+        scores = classifier.score_many(
+            ['cheap pills', 'great article', '']
+        )
+        self.failUnless(scores[0] > 0.7)
+        self.failUnless(scores[1] < 0.3)
+        self.failUnlessAlmostEqual(scores[2], classifier.spamprob(''))
+
+        # Further training copies the weights rather than writing through.
+        classifier.learn('cheap pills', False)
+        self.failUnless(classifier.weights.flags.writeable)
+
+    def test_versions(self):
+        trainer = self.classifier_class(self.path, n_features=2 ** 12)
+        trainer.learn('buy cheap pills now', True)
+        first_version = trainer.store()
+        worker = self.classifier_class(self.path)
+        self.failUnlessEqual(worker.version, first_version)
+
+        trainer.learn('buy cheap pills now', True)
+        second_version = trainer.store()
+        self.failIfEqual(first_version, second_version)
+        self.failUnlessEqual(
+            trainer.registry.get_versions(),
+            [first_version, second_version]
+        )
+
+        # Workers only check for new versions every reload_interval seconds.
+        worker.refresh()
+        self.failUnlessEqual(worker.version, first_version)
+        worker.refresh(force=True)
+        self.failUnlessEqual(worker.version, second_version)
+
+        # Rolling back makes the previous version current again.
+        moderator_settings = dict(
+            settings.MODERATOR,
+            CLASSIFIER='moderator.linear.HashingClassifier',
+            CLASSIFIER_CONFIG={'path': self.path}
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            call_command('rollbackclassifier', stdout=StringIO())
+            stdout = StringIO()
+            call_command('rollbackclassifier', list=True, stdout=stdout)
+        self.failUnless('%s (current)' % first_version in stdout.getvalue())
+        worker.refresh(force=True)
+        self.failUnlessEqual(worker.version, first_version)
+
+    def test_other_files(self):
+        # Other files sharing the path as a prefix aren't versions, so are
+        # neither listed nor removed along with old versions.
+        backup_path = '%s.bak' % self.path
+        open(backup_path, 'w').close()
+        trainer = self.classifier_class(
+            self.path,
+            n_features=2 ** 12,
+            keep_versions=1
+        )
+        trainer.learn('buy cheap pills now', True)
+        trainer.store()
+        trainer.learn('buy cheap pills now', True)
+        version = trainer.store()
+        self.failUnlessEqual(trainer.registry.get_versions(), [version])
+        self.failUnless(os.path.exists(backup_path))
+        self.failUnlessRaises(ValueError, trainer.registry.activate, 'bak')
+
+    def test_train_command(self):
+        from moderator import utils
+        from moderator.models import ClassifiedComment
+        # Only train on this test's decisions, not those left by others.
+        ClassifiedComment.objects.filter(moderated=True).update(
+            moderated=False
+        )
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment=text
+            ) for text in ['buy cheap pills now', 'great article', 'hello']
+        ]
+        utils.classify_comments(comments[:1], 'spam')
+        utils.classify_comments(comments[1:2], 'ham')
+        # Only moderator decisions are trained on.
+        self.failUnlessEqual(
+            list(ClassifiedComment.objects.filter(
+                comment__in=comments
+            ).order_by('comment').values_list('moderated', flat=True)),
+            [True, True, False]
+        )
+
+        moderator_settings = dict(
+            settings.MODERATOR,
+            CLASSIFIER='moderator.linear.HashingClassifier',
+            CLASSIFIER_CONFIG={'path': self.path, 'n_features': 2 ** 12}
+        )
+        stdout = StringIO()
+        with override_settings(MODERATOR=moderator_settings):
+            call_command(
+                'trainclassifier',
+                chunk_size=1,
+                reset=True,
+                stdout=stdout
+            )
+        output = stdout.getvalue()
+        self.failUnless('(1 spam, 1 ham)' in output)
+        self.failUnless('Stored model version' in output)
+        classifier = self.classifier_class(self.path)
+        self.failUnless(classifier.spamprob('cheap pills') > 0.5)
+        self.failUnless(classifier.spamprob('great article') < 0.5)
+
+
+class TokenizerTestCase(TestCase):
+    def test_tokenize(self):
+        from moderator import tokenizer
+        self.failUnlessEqual(
+            tokenizer.tokenize(
+                u'FREEEE \uff43\uff41\uff53\uff48!!!! fr\u200bee '
+                u'https://www.Example.com/offer call 0800123456 \u263a'
+            ),
+            ['free', 'cash', 'punct:!!', 'free', 'url:example.com', 'call',
+             'num:10', 'emoji:263a']
+        )
+        self.failUnlessEqual(
+            tokenizer.ngrams(['buy', 'cheap', 'pills'], 2),
+            ['buy cheap', 'cheap pills']
+        )
+        self.failUnlessEqual(
+            tokenizer.char_ngrams('abc', 3),
+            [' ab', 'abc', 'bc ']
+        )
+
+    def test_memoized(self):
+        from moderator import tokenizer
+        cache = tokenizer.normalize_chunk.cache
+        cache.clear()
+        tokenizer.tokenize('spam spam spam')
+        self.failUnlessEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_lru_cache(self):
+        from moderator.lru import LRUCache
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Getting a makes b the least recently used item, evicted next.
+        self.failUnlessEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.failUnlessEqual(len(cache), 2)
+        self.failUnlessEqual(cache.get('b'), None)
+        self.failUnlessEqual(cache.get('a'), 1)
+        self.failUnlessEqual(cache.get('c'), 3)
+
+
 class UtilsTestCase(TestCase):
     def setUp(self):
         from moderator import utils
@@ -173,6 +544,1030 @@ class UtilsTestCase(TestCase):
 
         classified_comment = self.utils.classify_comment(spam_comment, 'spam')
 
+    def test_classify_comments(self):
+        from moderator.models import ClassifiedComment
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment="bulk comment %s" % i
+            ) for i in range(0, 3)
+        ]
+        comment_ids = [comment.id for comment in comments]
+        for i in range(0, 3):
+            Vote.objects.create(
+                content_type=ContentType.objects.get_for_model(Comment),
+                object_id=comments[0].id,
+                token='bulk%s' % i,
+                vote=-1
+            )
+
+        # Without providing a class reported comments should be classified as
+        # reported and removed, the rest as unsure.
+        counts = self.utils.classify_comments(comment_ids)
+        self.failUnlessEqual(counts, {'reported': 1, 'unsure': 2})
+        self.failUnlessEqual(
+            ClassifiedComment.objects.get(comment=comments[0]).cls,
+            'reported'
+        )
+        self.failUnless(Comment.objects.get(pk=comments[0].pk).is_removed)
+        self.failIf(Comment.objects.get(pk=comments[1].pk).is_removed)
+
+        # Providing spam should reclassify existing classifications, removing
+        # the comments.
+        queryset = Comment.objects.filter(pk__in=comment_ids)
+        counts = self.utils.classify_comments(queryset, 'spam')
+        self.failUnlessEqual(counts, {'spam': 3})
+        self.failUnlessEqual(
+            ClassifiedComment.objects.filter(
+                comment__in=comment_ids,
+                cls='spam'
+            ).count(),
+            3
+        )
+        self.failUnlessEqual(
+            Comment.objects.filter(pk__in=comment_ids, is_removed=True).count(),
+            3
+        )
+
+        # Providing ham should restore the comments.
+        self.utils.classify_comments(comments, 'ham')
+        self.failUnlessEqual(
+            Comment.objects.filter(pk__in=comment_ids, is_removed=False).count(),
+            3
+        )
+
+        # Should raise exception with unkown cls.
+        self.assertRaises(Exception, self.utils.classify_comments,
+                          comment_ids, 'unknown_cls')
+
+
+class AbuseCountTestCase(TestCase):
+    def test_abuse_count(self):
+        from moderator.utils import get_abuse_counts
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment="abuse count comment"
+        )
+        vote = Vote.objects.create(
+            content_type=ContentType.objects.get_for_model(Comment),
+            object_id=comment.id,
+            token='abusecount',
+            vote=-1
+        )
+        self.failUnlessEqual(get_abuse_counts([comment.id]), {comment.id: 1})
+
+        # Changing a report to a like should decrement the count.
+        vote.vote = 1
+        vote.save()
+        self.failUnlessEqual(get_abuse_counts([comment.id]), {comment.id: 0})
+
+        vote.vote = -1
+        vote.save()
+        self.failUnlessEqual(get_abuse_counts([comment.id]), {comment.id: 1})
+
+        # Deleting a report should decrement the count.
+        vote.delete()
+        self.failUnlessEqual(get_abuse_counts([comment.id]), {comment.id: 0})
+
+    def test_report_flags_comment(self):
+        from moderator.models import ClassifiedComment
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment="flagged comment"
+        )
+        for i in range(0, 3):
+            self.failIf(Comment.objects.get(pk=comment.pk).is_removed)
+            Vote.objects.create(
+                content_type=ContentType.objects.get_for_model(Comment),
+                object_id=comment.id,
+                token='flag%s' % i,
+                vote=-1
+            )
+
+        # Reaching the cutoff should classify the comment as reported.
+        self.failUnless(Comment.objects.get(pk=comment.pk).is_removed)
+        self.failUnlessEqual(
+            ClassifiedComment.objects.get(comment=comment).cls,
+            'reported'
+        )
+
+    def test_coalesced_report_flags_comment(self):
+        moderator_settings = dict(
+            settings.MODERATOR,
+            FLAG_COALESCE_WINDOW=60
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            self.test_report_flags_comment()
+
+    def test_coalescing_queue(self):
+        from moderator.batching import CoalescingQueue
+
+        class Task(object):
+            scheduled = 0
+
+            def apply_async(self, countdown):
+                self.scheduled += 1
+
+        task = Task()
+        queue = CoalescingQueue('test', task)
+        queue.pop()
+
+        # Ids should be deduplicated and the task scheduled once per window.
+        queue.add([1, 2], 60)
+        queue.add([2, 3], 60)
+        self.failUnlessEqual(task.scheduled, 1)
+        self.failUnlessEqual(queue.pop(), [1, 2, 3])
+        self.failUnlessEqual(queue.pop(), [])
+
+        # Once popped, newly buffered ids schedule the task again.
+        queue.add([4], 60)
+        self.failUnlessEqual(task.scheduled, 2)
+        self.failUnlessEqual(queue.pop(), [4])
+
+    def test_redis_counter(self):
+        from moderator.counters import RedisAbuseCounter
+        counter = RedisAbuseCounter()
+        counter.clear()
+        self.failUnlessEqual(counter.incr(1), 1)
+        self.failUnlessEqual(counter.incr(1), 2)
+        self.failUnlessEqual(counter.incr(1, -1), 1)
+        self.failUnlessEqual(counter.incr(2, 3), 3)
+        self.failUnlessEqual(counter.get_many([1, 2, 3]), {1: 1, 2: 3})
+
+        counter.clear()
+        counter.set_many({1: 5})
+        self.failUnlessEqual(counter.get_many([1, 2]), {1: 5})
+        counter.clear()
+
+    def test_reconcile(self):
+        from moderator.models import CommentAbuseCount
+        from moderator.utils import get_abuse_counts
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment="reconcile comment"
+        )
+        for i in range(0, 2):
+            Vote.objects.create(
+                content_type=ContentType.objects.get_for_model(Comment),
+                object_id=comment.id,
+                token='reconcile%s' % i,
+                vote=-1
+            )
+        CommentAbuseCount.objects.filter(comment=comment).update(count=10)
+
+        call_command('reconcileabusecounts', stdout=StringIO())
+        self.failUnlessEqual(get_abuse_counts([comment.id]), {comment.id: 2})
+
+
+class DenormalizationTestCase(TestCase):
+    def setUp(self):
+        from moderator import utils
+        self.utils = utils
+
+    def test_classified_comment_fields(self):
+        from moderator.models import ClassifiedComment
+        user = User.objects.create(username='denormalized')
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            user=user,
+            comment="denormalized comment"
+        )
+
+        # Fields should be denormalized on classification.
+        classified_comment = ClassifiedComment.objects.get(comment=comment)
+        self.failUnlessEqual(classified_comment.submit_date, comment.submit_date)
+        self.failUnlessEqual(classified_comment.site_id, 1)
+        self.failIf(classified_comment.is_removed)
+        self.failIf(classified_comment.staff_authored)
+
+        # And kept in sync as classifications, comments and users change.
+        self.utils.classify_comments([comment], 'spam')
+        self.failUnless(
+            ClassifiedComment.objects.get(comment=comment).is_removed
+        )
+        comment = Comment.objects.get(pk=comment.pk)
+        comment.is_removed = False
+        comment.save()
+        self.failIf(ClassifiedComment.objects.get(comment=comment).is_removed)
+        user.is_staff = True
+        user.save()
+        self.failUnless(
+            ClassifiedComment.objects.get(comment=comment).staff_authored
+        )
+
+        # Saving users without changing their staff status, i.e. on login,
+        # leaves their classified comments alone.
+        ClassifiedComment.objects.filter(comment=comment).update(
+            staff_authored=False
+        )
+        user = User.objects.get(pk=user.pk)
+        user.save()
+        self.failIf(
+            ClassifiedComment.objects.get(comment=comment).staff_authored
+        )
+
+    def test_one_classification_per_comment(self):
+        from moderator.models import ClassifiedComment
+        comment = Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment="upserted comment"
+        )
+
+        # Reclassifying should update the comment's classification in place.
+        for cls in ['spam', 'ham', 'reported', 'unsure']:
+            self.utils.classify_comments([comment], cls)
+            classified_comments = ClassifiedComment.objects.filter(
+                comment=comment
+            )
+            self.failUnlessEqual(classified_comments.count(), 1)
+            self.failUnlessEqual(classified_comments[0].cls, cls)
+        # Unsure leaves is_removed as set by the preceding reported class.
+        self.failUnless(
+            ClassifiedComment.objects.get(comment=comment).is_removed
+        )
+
+        # And a second classification can't be created.
+        self.assertRaises(
+            IntegrityError,
+            ClassifiedComment.objects.create,
+            comment=comment,
+            cls='spam'
+        )
+        transaction.rollback_unless_managed()
+
+
+class AsyncClassificationTestCase(TestCase):
+    def create_comment(self):
+        return Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment="async comment"
+        )
+
+    def test_async_classification(self):
+        from moderator.models import ClassifiedComment
+        moderator_settings = dict(
+            settings.MODERATOR,
+            ASYNC_CLASSIFICATION=True
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            # Outside of managed transactions comments are queued as they're
+            # created, tasks are run eagerly by the test settings.
+            comment = self.create_comment()
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'unsure'
+            )
+
+            # Within managed transactions in requests comments are queued
+            # once the request is finished.
+            request_started.send(sender=self.__class__)
+            with transaction.commit_on_success():
+                comment = self.create_comment()
+            self.failIf(
+                ClassifiedComment.objects.filter(comment=comment).exists()
+            )
+            request_finished.send(sender=self.__class__)
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'unsure'
+            )
+
+            # Outside of requests they are queued right away rather than
+            # buffered indefinitely.
+            with transaction.commit_on_success():
+                comment = self.create_comment()
+                self.failUnlessEqual(
+                    ClassifiedComment.objects.get(comment=comment).cls,
+                    'unsure'
+                )
+
+    def test_coalesced_async_classification(self):
+        moderator_settings = dict(
+            settings.MODERATOR,
+            CLASSIFY_COALESCE_WINDOW=60
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            self.test_async_classification()
+
+
+class VerdictCacheTestCase(TestCase):
+    def tearDown(self):
+        from moderator import utils
+        client = utils.get_redis_client()
+        keys = client.keys('moderator:verdict:*')
+        if keys:
+            client.delete(*keys)
+
+    def create_comment(self, text):
+        return Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment=text
+        )
+
+    def test_verdict_cache(self):
+        from moderator import utils
+        from moderator.models import ClassifiedComment
+        from moderator.verdicts import get_content_hash
+        self.failUnlessEqual(
+            get_content_hash('Buy CHEAP   pills!!!!'),
+            get_content_hash('buy cheap pills!!')
+        )
+        self.failUnlessEqual(get_content_hash(' '), None)
+
+        moderator_settings = dict(
+            settings.MODERATOR,
+            VERDICT_CACHE_TIMEOUT=3600
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            comment = self.create_comment('Buy cheap pills!!')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'unsure'
+            )
+
+            # Once a moderator marks a text as spam copies of it are
+            # classified as spam too.
+            utils.classify_comments([comment], 'spam')
+            duplicate = self.create_comment('buy CHEAP pills!!!')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=duplicate).cls,
+                'spam'
+            )
+            self.failUnless(Comment.objects.get(pk=duplicate.pk).is_removed)
+
+            # Reversing the decision replaces the cached verdict.
+            utils.classify_comments([duplicate], 'ham')
+            duplicate = self.create_comment('buy cheap pills!!')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=duplicate).cls,
+                'ham'
+            )
+
+
+class ClusteringTestCase(TestCase):
+    def create_comment(self, text):
+        return Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment=text
+        )
+
+    def test_clusters(self):
+        from moderator import utils
+        from moderator.admin import CommentAdmin
+        from moderator.models import ClassifiedComment
+        from django.contrib import admin
+        moderator_settings = dict(settings.MODERATOR, CLUSTERING=True)
+        with override_settings(MODERATOR=moderator_settings):
+            comment = self.create_comment(
+                'Earn 500 dollars a day working from home with this one '
+                'simple trick, visit our site now and sign up today'
+            )
+            near_duplicate = self.create_comment(
+                'Earn 700 dollars a day working from home with this one '
+                'simple trick, visit our site now and sign up tonight'
+            )
+            other = self.create_comment(
+                'I really enjoyed this article about the local football team '
+                'and their new coach'
+            )
+            short = self.create_comment('Nice one')
+
+            # Near-duplicates join the cluster of the first comment.
+            clusters = dict(ClassifiedComment.objects.filter(
+                comment__in=[comment, near_duplicate, other, short]
+            ).values_list('comment_id', 'cluster_id'))
+            self.failUnlessEqual(clusters[comment.pk], comment.pk)
+            self.failUnlessEqual(clusters[near_duplicate.pk], comment.pk)
+            self.failUnlessEqual(clusters[other.pk], other.pk)
+            self.failUnlessEqual(clusters[short.pk], None)
+
+            # Classifying a comment's cluster classifies its near-duplicates.
+            comment_admin = CommentAdmin(Comment, admin.site)
+            counts = utils.classify_comments(
+                comment_admin.get_cluster_queryset(
+                    Comment.objects.filter(pk=near_duplicate.pk)
+                ),
+                cls='spam'
+            )
+            self.failUnlessEqual(counts, {'spam': 2})
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=other).cls,
+                'unsure'
+            )
+
+    def test_many_clusters(self):
+        from django.db.models import F
+        from moderator.clustering import assign_clusters
+        from moderator.models import ClassifiedComment
+        # More buckets than SQLite binds parameters in a single statement.
+        count = 70
+        comments = [
+            self.create_comment('w%s x%s y%s z%s' % ((i, ) * 4))
+            for i in range(count)
+        ]
+        clusters = assign_clusters([comment.pk for comment in comments])
+        self.failUnlessEqual(len(clusters), count)
+        self.failUnlessEqual(
+            ClassifiedComment.objects.filter(
+                comment__in=comments,
+                cluster=F('comment')
+            ).count(),
+            count
+        )
+
+
+class BlocklistTestCase(TestCase):
+    def tearDown(self):
+        from moderator.models import BlockedPhrase
+        BlockedPhrase.objects.all().delete()
+
+    def create_comment(self, text):
+        return Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment=text
+        )
+
+    def test_automaton(self):
+        from moderator.rules import Automaton
+        automaton = Automaton([
+            (('cheap', 'pills'), 'spam'),
+            (('pills', 'online'), 'unsure'),
+            (('online', ), 'ham'),
+        ])
+        self.failUnlessEqual(
+            automaton.find(['buy', 'cheap', 'pills', 'online']),
+            set(['spam', 'unsure', 'ham'])
+        )
+        self.failUnlessEqual(automaton.find(['cheap', 'pill']), set())
+
+    def test_version(self):
+        from moderator.models import BlockedPhrase
+        from moderator.rules import BLOCKLIST_VERSION_KEY, get_version
+        version = get_version(BLOCKLIST_VERSION_KEY)
+        # Within managed transactions in requests the version is changed once
+        # the request is finished, by when phrases have been committed.
+        request_started.send(sender=self.__class__)
+        with transaction.commit_on_success():
+            BlockedPhrase.objects.create(phrase='cheap pills', cls='spam')
+        self.failUnlessEqual(get_version(BLOCKLIST_VERSION_KEY), version)
+        request_finished.send(sender=self.__class__)
+        self.failIfEqual(get_version(BLOCKLIST_VERSION_KEY), version)
+
+        # Outside of requests it's changed right away.
+        version = get_version(BLOCKLIST_VERSION_KEY)
+        BlockedPhrase.objects.all().delete()
+        self.failIfEqual(get_version(BLOCKLIST_VERSION_KEY), version)
+
+    def test_blocklist_stage(self):
+        from moderator.models import BlockedPhrase, ClassifiedComment
+        moderator_settings = dict(
+            settings.MODERATOR,
+            CLASSIFICATION_STAGES=['moderator.rules.blocklist_stage']
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            BlockedPhrase.objects.create(phrase='Cheap pills')
+            BlockedPhrase.objects.create(phrase='crypto', cls='unsure')
+            comment = self.create_comment('Buy CHEAP   pills!!')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'spam'
+            )
+            self.failUnless(Comment.objects.get(pk=comment.pk).is_removed)
+            comment = self.create_comment('Cheap crypto and cheap pills')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'spam'
+            )
+            comment = self.create_comment('Crypto tips')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'unsure'
+            )
+
+            # Changes to the blocklist are picked up.
+            BlockedPhrase.objects.filter(phrase='Cheap pills').delete()
+            comment = self.create_comment('Buy cheap pills')
+            self.failIfEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'spam'
+            )
+
+
+class RegexRuleTestCase(TestCase):
+    def tearDown(self):
+        from moderator.models import RegexRule
+        RegexRule.objects.all().delete()
+
+    def test_compile_regex_rules(self):
+        from moderator.rules import compile_regex_rules
+        pattern, classes = compile_regex_rules([
+            (1, r'\+?\d[\d -]{8,}\d', 'unsure'),
+            (2, r'bit\.ly/\w+', 'spam'),
+            (3, r'x*', 'spam'),
+            (4, r'(invalid', 'spam'),
+            (5, r'(a)\1', 'spam'),
+            (6, r'cheap pills', 'unsure'),
+            (7, r'pills now', 'spam'),
+            (8, r'(?x) \d{3} - \d{4}', 'spam'),
+            (9, r'(?P<name>named)', 'spam'),
+        ])
+        # Spam rules are tried first, invalid rules are left out.
+        self.failUnlessEqual(classes, {
+            'rule_2': 'spam',
+            'rule_7': 'spam',
+            'rule_1': 'unsure',
+            'rule_6': 'unsure',
+        })
+        self.failUnlessEqual(
+            set(match.lastgroup for match in pattern.finditer(
+                'Call +27 82 555 1234 or visit BIT.LY/abc'
+            )),
+            set(['rule_1', 'rule_2'])
+        )
+        # Overlapping matches are all found.
+        self.failUnlessEqual(
+            set(match.lastgroup for match in pattern.finditer(
+                'cheap pills now'
+            )),
+            set(['rule_6', 'rule_7'])
+        )
+        # Other rules' inline flags don't change how rules match.
+        self.failIf(pattern.search('cheappills'))
+
+    def test_regex_stage(self):
+        from django.core.exceptions import ValidationError
+        from moderator.models import ClassifiedComment, RegexRule
+        self.failUnlessRaises(
+            ValidationError,
+            RegexRule(name='Empty', pattern='a*').clean
+        )
+        self.failUnlessRaises(
+            ValidationError,
+            RegexRule(name='Repeated', pattern=r'(\w)\1{3}').clean
+        )
+        self.failUnlessRaises(
+            ValidationError,
+            RegexRule(name='Verbose', pattern=r'(?x) \d{3} - \d{4}').clean
+        )
+        moderator_settings = dict(
+            settings.MODERATOR,
+            CLASSIFICATION_STAGES=['moderator.rules.regex_stage']
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            RegexRule.objects.create(
+                name='Phone number',
+                pattern=r'\+?\d[\d -]{8,}\d',
+                cls='unsure'
+            )
+            rule = RegexRule.objects.create(
+                name='Shortener',
+                pattern=r'bit\.ly/\w+'
+            )
+            comment = Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment='Call +27 82 555 1234 or visit bit.ly/abc'
+            )
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'spam'
+            )
+
+            # Inactive rules are left out once the rule set changes.
+            rule.is_active = False
+            rule.save()
+            comment = Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment='Visit bit.ly/abc'
+            )
+            self.failIfEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'spam'
+            )
+
+
+class DomainReputationTestCase(TestCase):
+    def tearDown(self):
+        from moderator import domains
+        from moderator.models import DomainReputation
+        DomainReputation.objects.all().delete()
+        domains._reputations.clear()
+
+    def create_comment(self, text):
+        return Comment.objects.create(
+            content_type_id=1,
+            site_id=1,
+            comment=text
+        )
+
+    def test_get_domains(self):
+        from moderator.domains import get_domains
+        self.failUnlessEqual(
+            get_domains(
+                'Visit http://www.Shop.Spam.com/offer, '
+                'https://news.example.co.uk/ or spam.com'
+            ),
+            set(['spam.com', 'example.co.uk'])
+        )
+
+    def test_domain_reputation_stage(self):
+        from moderator import utils
+        from moderator.domains import get_reputations
+        from moderator.models import ClassifiedComment
+        moderator_settings = dict(
+            settings.MODERATOR,
+            CLASSIFICATION_STAGES=[
+                'moderator.domains.domain_reputation_stage'
+            ],
+            DOMAIN_REPUTATION=True,
+            DOMAIN_SPAM_MINIMUM=2
+        )
+        with override_settings(MODERATOR=moderator_settings):
+            comments = [
+                self.create_comment('Deals at http://spam.com/%s' % i)
+                for i in range(3)
+            ]
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comments[0]).cls,
+                'unsure'
+            )
+
+            # Moderator decisions are counted towards domains' reputations,
+            # reversed decisions are discounted.
+            utils.classify_comments(comments, 'spam')
+            utils.classify_comments(comments[:1], 'ham')
+            self.failUnlessEqual(
+                get_reputations(['spam.com', 'example.com']),
+                {'spam.com': (2, 1), 'example.com': (0, 0)}
+            )
+
+            comment = self.create_comment('More at https://www.spam.com/')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'unsure'
+            )
+            utils.classify_comments([comments[0]], 'spam')
+            comment = self.create_comment('More at https://www.spam.com/')
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'spam'
+            )
+
+
+class ClassifyCommentsCommandTestCase(TestCase):
+    def test_checkpoint(self):
+        from moderator.models import ClassifiedComment
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment="command comment %s" % i
+            ) for i in range(0, 3)
+        ]
+        # Comments are classified as they're created, start unclassified.
+        ClassifiedComment.objects.filter(comment__in=comments).delete()
+        checkpoint = tempfile.mktemp()
+
+        # Resuming from a checkpoint should skip comments up to and including
+        # the checkpointed comment.
+        with open(checkpoint, 'w') as f:
+            f.write('%s' % comments[0].pk)
+        call_command(
+            'classifycomments',
+            chunk_size=1,
+            checkpoint=checkpoint,
+            stdout=StringIO()
+        )
+        self.failIf(ClassifiedComment.objects.filter(
+            comment=comments[0]
+        ).exists())
+        for comment in comments[1:]:
+            self.failUnlessEqual(
+                ClassifiedComment.objects.get(comment=comment).cls,
+                'unsure'
+            )
+
+        # A completed run removes its checkpoint.
+        self.failIf(os.path.exists(checkpoint))
+
+    def test_count(self):
+        from moderator.management.commands.classifycomments import \
+            get_default_checkpoint
+        from moderator.models import ClassifiedComment
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment="counted comment %s" % i
+            ) for i in range(0, 2)
+        ]
+        ClassifiedComment.objects.filter(comment__in=comments).delete()
+        checkpoint = get_default_checkpoint()
+        with open(checkpoint, 'w') as f:
+            f.write('%s' % (comments[0].pk - 1))
+
+        # Count limited runs continue after the previous run rather than
+        # classifying the same unsure comments again.
+        try:
+            for comment in comments:
+                call_command('classifycomments', count=1, stdout=StringIO())
+                self.failUnlessEqual(
+                    ClassifiedComment.objects.get(comment=comment).cls,
+                    'unsure'
+                )
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+    def test_split_range(self):
+        from moderator.management.commands.classifycomments import \
+            split_range
+        # Ranges are contiguous and cover all primary keys exactly once.
+        ranges = split_range(0, 10, 4)
+        self.failUnlessEqual(ranges[0][0], 0)
+        self.failUnlessEqual(ranges[-1][1], 10)
+        for previous, following in zip(ranges, ranges[1:]):
+            self.failUnlessEqual(previous[1], following[0])
+        self.failUnless(all(after < until for after, until in ranges))
+
+        # Fewer primary keys than ranges gives a range per primary key.
+        self.failUnlessEqual(split_range(5, 7, 8), [(5, 6), (6, 7)])
+        self.failUnlessEqual(split_range(3, 3, 4), [])
+
+    def test_classify_range_bounds(self):
+        from moderator.management.commands.classifycomments import \
+            classify_range
+        from moderator.models import ClassifiedComment
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment="range comment %s" % i
+            ) for i in range(0, 3)
+        ]
+        ClassifiedComment.objects.filter(comment__in=comments).delete()
+
+        # Only comments within the range are classified.
+        total, counts, finished = classify_range(
+            comments[0].pk,
+            1,
+            until_pk=comments[1].pk
+        )
+        self.failUnlessEqual(total, 1)
+        self.failUnless(finished)
+        self.failUnlessEqual(
+            set(ClassifiedComment.objects.filter(
+                comment__in=comments
+            ).values_list('comment_id', flat=True)),
+            set([comments[1].pk])
+        )
+
+    def test_workers_options(self):
+        from django.core.management.base import CommandError
+        from moderator.management.commands.classifycomments import Command
+        options = {
+            'count': 0,
+            'chunk_size': 1000,
+            'checkpoint': None,
+            'workers': 2,
+        }
+        for option, value in (('count', 10), ('checkpoint', 'checkpoint')):
+            command = Command()
+            command.stdout = StringIO()
+            self.assertRaises(
+                CommandError,
+                command.handle,
+                **dict(options, **{option: value})
+            )
+
+
+class CommentReplyTestCase(TestCase):
+    def test_reply_comments(self):
+        from moderator.models import ClassifiedComment, CommentReply
+        user = User.objects.create(username='replier', is_staff=True)
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                object_pk=i,
+                site_id=1,
+                comment="replied to comment %s" % i
+            ) for i in range(0, 3)
+        ]
+        reply = CommentReply.objects.create(user=user, comment='reply')
+        reply.replied_to_comments.add(*comments[:2])
+
+        # A reply comment should be created for each comment replied to.
+        reply_comments = reply.reply_comments.all()
+        self.failUnlessEqual(reply_comments.count(), 2)
+        for comment in comments[:2]:
+            reply_comment = reply_comments.get(object_pk=comment.object_pk)
+            self.failUnlessEqual(reply_comment.comment, 'reply')
+            self.failUnlessEqual(reply_comment.user, user)
+
+        # Replying to further comments should update existing reply comments
+        # rather than duplicating them.
+        reply.comment = 'updated reply'
+        reply.save()
+        reply.replied_to_comments.add(comments[2])
+        reply_comments = reply.reply_comments.all()
+        self.failUnlessEqual(reply_comments.count(), 3)
+        self.failUnlessEqual(
+            reply_comments.filter(comment='updated reply').count(),
+            3
+        )
+
+        # Reply comments should not be classified.
+        self.failIf(ClassifiedComment.objects.filter(
+            comment__in=reply_comments
+        ).exists())
+
+
+class ChangeListTestCase(TestCase):
+    def count_queries(self, func):
+        from django.db import connection
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            func()
+        finally:
+            connection.use_debug_cursor = None
+        return len(connection.queries) - start
+
+    def create_comments(self, objs, replier):
+        from moderator.models import CommentReply
+        comments = [
+            Comment.objects.create(
+                content_type=ContentType.objects.get_for_model(obj),
+                object_pk=obj.pk,
+                site_id=1,
+                comment='listed comment'
+            ) for obj in objs
+        ]
+        for comment in comments:
+            reply = CommentReply.objects.create(user=replier, comment='reply')
+            reply.replied_to_comments.add(comment)
+        return comments
+
+    def test_query_count(self):
+        from django.contrib import admin
+        from django.contrib.sites.models import Site
+        from moderator.admin import CommentAdmin
+        replier = User.objects.create(username='lister', is_staff=True)
+        commenter = User.objects.create(username='listed')
+        site = Site.objects.get(pk=1)
+
+        listed_ids = []
+
+        class ListedCommentAdmin(CommentAdmin):
+            # Only list this test's comments, not those left by others.
+            def queryset(self, request):
+                return super(ListedCommentAdmin, self).queryset(
+                    request
+                ).filter(pk__in=listed_ids)
+
+        model_admin = ListedCommentAdmin(Comment, admin.site)
+        request = RequestFactory().get('/')
+        request.user = User(is_active=True, is_superuser=True)
+        list_display = model_admin.get_list_display(request)
+        change_list_class = model_admin.get_changelist(request)
+
+        def get_results():
+            change_list = change_list_class(
+                request,
+                Comment,
+                list_display,
+                model_admin.get_list_display_links(request, list_display),
+                model_admin.list_filter,
+                model_admin.date_hierarchy,
+                model_admin.search_fields,
+                model_admin.list_select_related,
+                model_admin.list_per_page,
+                model_admin.list_max_show_all,
+                model_admin.list_editable,
+                model_admin
+            )
+            return change_list.result_list
+
+        # Comments on several content types, each replied to.
+        comments = self.create_comments([commenter, site], replier)
+        listed_ids.extend(comment.id for comment in comments)
+        num_queries = self.count_queries(get_results)
+
+        # More comments and replies on the page don't take more queries.
+        comments += self.create_comments([commenter, site] * 5, replier)
+        listed_ids.extend(comment.id for comment in comments)
+        self.failUnlessEqual(self.count_queries(get_results), num_queries)
+        self.failUnless(all(
+            comment.id in model_admin.comment_replies for comment in comments
+        ))
+
+    def test_invalid_object_pk(self):
+        from moderator.admin import get_content_objects
+        commenter = User.objects.create(username='invalid object pk')
+        # Object pks that aren't valid primary keys are left out rather than
+        # failing the lookup for all objects.
+        self.failUnlessEqual(
+            get_content_objects(User, [str(commenter.pk), '', 'invalid']),
+            {str(commenter.pk): commenter}
+        )
+        self.failUnlessEqual(get_content_objects(None, ['1']), {})
+
+
+class CappedCountPaginatorTestCase(TestCase):
+    def test_count(self):
+        from django.core.cache import cache
+        from moderator.paginator import CappedCount, CappedCountPaginator, \
+            get_count_cache_key
+        for i in range(0, 3):
+            Comment.objects.create(
+                content_type_id=1,
+                site_id=1,
+                comment="paginated comment %s" % i
+            )
+        queryset = Comment.objects.all()
+        cache.delete(get_count_cache_key(queryset))
+
+        # Counts beyond the cap should be capped.
+        paginator = CappedCountPaginator(queryset, 1, cap=2)
+        self.failUnless(isinstance(paginator.count, CappedCount))
+        self.failUnlessEqual(paginator.count, 2)
+        self.failUnlessEqual(unicode(paginator.count), u'2+')
+        self.failUnless(paginator.count_is_capped)
+
+        # Counts below the cap should be exact.
+        paginator = CappedCountPaginator(queryset, 1, cap=queryset.count())
+        self.failIf(paginator.count_is_capped)
+
+        # Exact counts are computed on request and then cached.
+        paginator = CappedCountPaginator(queryset, 1, cap=2, exact=True)
+        self.failUnlessEqual(paginator.count, queryset.count())
+        paginator = CappedCountPaginator(queryset, 1, cap=2)
+        self.failUnlessEqual(paginator.count, queryset.count())
+        self.failIf(paginator.count_is_capped)
+        cache.delete(get_count_cache_key(queryset))
+
+
+class KeysetPaginationTestCase(TestCase):
+    def test_keyset_page(self):
+        from moderator.paginator import decode_cursor, encode_cursor, \
+            get_keyset_page
+        comments = [
+            Comment.objects.create(
+                content_type_id=1,
+                object_pk='keyset',
+                site_id=1,
+                comment="keyset comment %s" % i
+            ) for i in range(0, 5)
+        ]
+        # Share a submit date to exercise the pk tie breaker.
+        Comment.objects.filter(pk__in=[c.pk for c in comments[1:3]]).update(
+            submit_date=comments[1].submit_date
+        )
+        queryset = Comment.objects.filter(object_pk='keyset')
+        expected = list(queryset.order_by('-submit_date', '-pk'))
+
+        def cursor(obj):
+            return decode_cursor(encode_cursor(obj.submit_date, obj.pk))
+
+        # First page.
+        objects, has_previous, has_next = get_keyset_page(
+            queryset, 'submit_date', 2)
+        self.failUnlessEqual(objects, expected[:2])
+        self.failIf(has_previous)
+        self.failUnless(has_next)
+
+        # Following pages are located after the last object.
+        objects, has_previous, has_next = get_keyset_page(
+            queryset, 'submit_date', 2, after=cursor(objects[-1]))
+        self.failUnlessEqual(objects, expected[2:4])
+        self.failUnless(has_previous)
+        self.failUnless(has_next)
+
+        objects, has_previous, has_next = get_keyset_page(
+            queryset, 'submit_date', 2, after=cursor(objects[-1]))
+        self.failUnlessEqual(objects, expected[4:])
+        self.failIf(has_next)
+
+        # Preceding pages are located before the first object.
+        objects, has_previous, has_next = get_keyset_page(
+            queryset, 'submit_date', 2, before=cursor(objects[0]))
+        self.failUnlessEqual(objects, expected[2:4])
+        self.failUnless(has_previous)
+        self.failUnless(has_next)
+
+        self.assertRaises(ValueError, decode_cursor, 'invalid')
+
 
 class InclusionTagsTestCase(TestCase):
 
@@ -0,0 +1,118 @@
+"""
+Tokenizer shared by classifiers, rules and duplicate detection so that text
+is normalized the same way, and only once, everywhere.
+
+Text is split on whitespace into chunks, each chunk normalized into tokens:
+
+- URLs become url:<domain> tokens and emoji emoji:<codepoint> tokens.
+- The rest is transliterated to ASCII, folding homoglyphs such as Cyrillic
+  or fullwidth letters onto their lookalikes, and lowercased.
+- Characters repeated more than twice are collapsed to two, so "freeeee"
+  and "free!!!!!!" are tokenized alike as "free" and "free", punct:!!.
+- Numbers become num:<number of digits> tokens.
+
+Zero width characters, often used to break up words, are removed up front.
+Chunks repeat a lot, especially in spam bursts, so their tokens are
+memoized in a bounded LRU cache.
+"""
+import re
+
+from moderator.lru import memoize
+from unidecode import unidecode
+
+
+# Number of distinct chunks whose tokens are memoized.
+NORMALIZE_CACHE_SIZE = 100000
+
+ZERO_WIDTH_CHARACTERS = dict.fromkeys(
+    ord(c) for c in u'\u00ad\u200b\u200c\u200d\u200e\u200f\u2060\ufeff'
+)
+
+URL_RE = re.compile(
+    r'^(?:[a-z][a-z0-9+.-]*://|www\.)(?:[^/?#@\s]*@)?([^/?#:\s]+)',
+    re.IGNORECASE
+)
+
+try:
+    EMOJI_RE = re.compile(u'[\U0001f300-\U0001faff\u2600-\u27bf]')
+except re.error:
+    # Narrow Python builds represent astral characters as surrogate pairs.
+    EMOJI_RE = re.compile(
+        u'(?:[\ud83c-\ud83e][\udc00-\udfff]|[\u2600-\u27bf])'
+    )
+
+REPEATED_RE = re.compile(r'(.)\1{2,}')
+
+WORD_RE = re.compile(r"[a-z0-9$'-]+|[!?]{2,}")
+
+
+def tokenize(text):
+    """
+    Returns the list of normalized tokens in text, in order.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    tokens = []
+    for chunk in text.translate(ZERO_WIDTH_CHARACTERS).split():
+        tokens.extend(normalize_chunk(chunk))
+    return tokens
+
+
+@memoize(NORMALIZE_CACHE_SIZE)
+def normalize_chunk(chunk):
+    """
+    Returns a tuple of the normalized tokens in a chunk of text without
+    whitespace.
+    """
+    match = URL_RE.match(chunk)
+    if match:
+        domain = unidecode(match.group(1)).lower().strip('.')
+        if domain.startswith('www.'):
+            domain = domain[4:]
+        return ('url:%s' % domain, )
+
+    tokens = [get_emoji_token(emoji) for emoji in EMOJI_RE.findall(chunk)]
+    chunk = REPEATED_RE.sub(r'\1\1', unidecode(EMOJI_RE.sub(' ', chunk)))
+    for word in WORD_RE.findall(chunk.lower()):
+        if word[0] in '!?':
+            tokens.append('punct:%s' % word[:3])
+            continue
+        word = word.strip("'-")
+        if word.isdigit():
+            tokens.append('num:%s' % len(word))
+        elif word:
+            tokens.append(word)
+    return tuple(tokens)
+
+
+def get_emoji_token(emoji):
+    if len(emoji) == 2:
+        # Surrogate pair.
+        codepoint = 0x10000 + ((ord(emoji[0]) - 0xd800) << 10) + \
+            (ord(emoji[1]) - 0xdc00)
+    else:
+        codepoint = ord(emoji)
+    return 'emoji:%x' % codepoint
+
+
+def is_canonical(token):
+    """
+    Returns whether a token stands for a URL, emoji, number or punctuation
+    rather than a word.
+    """
+    return ':' in token
+
+
+def ngrams(tokens, n):
+    """
+    Returns the list of space separated n-grams of a sequence of tokens.
+    """
+    return [' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1)]
+
+
+def char_ngrams(token, n):
+    """
+    Returns the list of character n-grams of a token padded with spaces.
+    """
+    padded = ' %s ' % token
+    return [padded[i:i + n] for i in range(len(padded) - n + 1)]
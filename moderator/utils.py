@@ -1,9 +1,42 @@
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import User
+from django.contrib.comments.models import Comment
+from django.db import IntegrityError, connection, transaction
+from django.db.models import AutoField
+from django.db.models.query import QuerySet
+from django.utils.importlib import import_module
 from moderator.constants import DEFAULT_CONFIG
-from secretballot.models import Vote
 from moderator import models
 
+# Number of comment ids handled per set based statement, kept below SQLite's
+# limit of 999 bound parameters per query.
+BULK_CHUNK_SIZE = 500
+
+# Value a comment's is_removed field is set to when classified as a class,
+# classes not listed leave is_removed untouched.
+REMOVED_BY_CLASS = {
+    'spam': True,
+    'ham': False,
+    'reported': True,
+}
+
+# Classes moderators classify comments as.
+MODERATED_CLASSES = ('spam', 'ham')
+
+
+def bulk_create(model, objs):
+    """
+    Inserts objs with as few bulk inserts as possible, each binding at most
+    BULK_CHUNK_SIZE parameters, since Django's bulk_create doesn't batch.
+    """
+    fields = [
+        field for field in model._meta.local_fields
+        if not isinstance(field, AutoField)
+    ]
+    batch_size = max(1, BULK_CHUNK_SIZE // len(fields))
+    for offset in range(0, len(objs), batch_size):
+        model.objects.bulk_create(objs[offset:offset + batch_size])
+
 
 def classify_comment(comment, cls=None):
     """
@@ -13,60 +46,519 @@ def classify_comment(comment, cls=None):
     If no class is provided a lookup is done to see if the comment has been
     reported by users as abusive. If indicated as abusive class is set
     as 'reported'and the comment being removed.
+
+    Classification is delegated to classify_comments so single comments and
+    batches are classified alike.
+    """
+    classify_comments([comment], cls)
+    classified_comment = models.ClassifiedComment.objects.select_related(
+        'comment'
+    ).get(comment=comment)
+    comment.is_removed = classified_comment.comment.is_removed
+    return classified_comment
+
+
+def classify_comments(comments, cls=None):
+    """
+    Bulk version of classify_comment. Classifies all comments in a queryset or
+    sequence of comments/comment ids using a constant number of set based
+    queries per chunk of comments instead of a handful of queries per comment.
+
+    If no class is provided comments reported by users as abusive are
+    classified as 'reported' and removed. The remainder are classified by
+    get_classifications as 'spam', and removed, 'ham' or 'unsure'. If
+    CLUSTERING is set comments are also assigned to clusters of
+    near-duplicates.
+
+    Returns a dictionary mapping classes to the number of comments classified
+    as such.
     """
     if cls not in ['spam', 'ham', 'unsure', 'reported', None]:
         raise Exception("Unrecognized classifications.")
 
-    classified_comment, cr = models.ClassifiedComment.objects.get_or_create(
-        comment=comment
-    )
+    counts = {}
+    comment_ids = get_comment_ids(comments)
+    # Comments are only explicitly classified as spam or ham by moderators,
+    # these classifications are what classifiers are trained on.
+    moderated = cls in MODERATED_CLASSES
+    for offset in range(0, len(comment_ids), BULK_CHUNK_SIZE):
+        chunk = comment_ids[offset:offset + BULK_CHUNK_SIZE]
+        if cls is None:
+            reported_ids = get_reported_comment_ids(chunk)
+            classes = {
+                'reported': [i for i in chunk if i in reported_ids],
+                'unsure': [i for i in chunk if i not in reported_ids],
+            }
+            if get_setting('CLASSIFICATION_STAGES') or \
+                    get_classifier() is not None or \
+                    get_verdict_cache() is not None:
+                classes.update(get_classifications(classes['unsure']))
+            _update_classifications(classes['reported'], 'reported', True)
+            _update_classifications(classes.get('spam', []), 'spam', True)
+            _update_classifications(classes.get('ham', []), 'ham', False)
+            _update_classifications(classes['unsure'], 'unsure', False)
+            if get_setting('CLUSTERING'):
+                from moderator.clustering import assign_clusters
+                assign_clusters(chunk)
+        else:
+            # As with classify_comment comments already classified as cls are
+            # left untouched.
+            unchanged_ids = set(models.ClassifiedComment.objects.filter(
+                comment__in=chunk,
+                cls=cls,
+                moderated=moderated
+            ).values_list('comment_id', flat=True))
+            classes = {cls: chunk}
+            changed_ids = [i for i in chunk if i not in unchanged_ids]
+            previous_classes = {}
+            if moderated or get_setting('ONLINE_TRAINING_WINDOW'):
+                previous_classes = dict(
+                    models.ClassifiedComment.objects.filter(
+                        comment__in=changed_ids,
+                        moderated=True
+                    ).values_list('comment_id', 'cls')
+                )
+            _update_classifications(
+                changed_ids,
+                cls,
+                REMOVED_BY_CLASS.get(cls),
+                moderated
+            )
+            # Moderator decisions replaced by unmoderated classes, i.e. once
+            # comments are reported, are unlearned too.
+            queue_training(changed_ids, cls, previous_classes)
+            if moderated:
+                cache_moderated_verdicts(chunk, cls)
+                from moderator.domains import update_reputations
+                update_reputations(changed_ids, cls, previous_classes)
+        for key, ids in classes.items():
+            counts[key] = counts.get(key, 0) + len(ids)
+
+    return counts
+
+
+def get_classifications(comment_ids):
+    """
+    Returns a dictionary mapping the classes 'spam', 'ham' and 'unsure' to
+    lists of the ids of comments classified as such. 'spam' and 'ham' are
+    omitted if no comments are classified as such.
 
-    if cls == 'spam' and classified_comment.cls != 'spam':
-        comment.is_removed = True
-        comment.save()
-        classified_comment.cls = cls
-        classified_comment.save()
-        return classified_comment
-
-    if cls == 'ham' and classified_comment.cls != 'ham':
-        comment.is_removed = False
-        comment.save()
-        classified_comment.cls = cls
-        classified_comment.save()
-        return classified_comment
-
-    if cls == 'unsure' and classified_comment.cls != 'unsure':
-        classified_comment.cls = cls
-        classified_comment.save()
-        return classified_comment
-
-    if cls == 'reported' and classified_comment.cls != 'reported':
-        comment.is_removed = True
-        comment.save()
-        classified_comment.cls = cls
-        classified_comment.save()
-        return classified_comment
-
-    if cls is None:
-        cls = 'unsure'
-        comment_content_type = ContentType.objects.get_for_model(comment)
-        moderator_settings = getattr(settings, 'MODERATOR', DEFAULT_CONFIG)
-        if Vote.objects.filter(
-            content_type=comment_content_type,
-            object_id=comment.id,
-            vote=-1
-        ).count() >= moderator_settings['ABUSE_CUTOFF']:
-            cls = 'reported'
-            comment.is_removed = True
-            comment.save()
-            classified_comment.cls = cls
-            classified_comment.save()
-            return classified_comment
+    Comments are first classified by the CLASSIFICATION_STAGES, in order,
+    each stage classifying the comments preceding stages didn't match.
+    Comments duplicating texts with verdicts in the verdict cache are given
+    the cached verdict. The rest are classified by the CLASSIFIER, if any,
+    based on the SPAM_CUTOFF and HAM_CUTOFF spam probability thresholds.
+    """
+    classifier = get_classifier()
+    verdict_cache = get_verdict_cache()
+    texts = dict(Comment.objects.filter(
+        pk__in=comment_ids
+    ).values_list('pk', 'comment'))
+    classes = {'unsure': []}
+
+    for path in get_setting('CLASSIFICATION_STAGES'):
+        if not comment_ids:
+            break
+        matches = load_class(path)(dict(
+            (comment_id, texts.get(comment_id)) for comment_id in comment_ids
+        ))
+        for comment_id, cls in matches.items():
+            classes.setdefault(cls, []).append(comment_id)
+        comment_ids = [i for i in comment_ids if i not in matches]
+
+    content_hashes = {}
+    verdicts = {}
+    if verdict_cache is not None:
+        from moderator.verdicts import get_content_hash
+        content_hashes = dict(
+            (comment_id, get_content_hash(texts.get(comment_id)))
+            for comment_id in comment_ids
+        )
+        verdicts = verdict_cache.get_many(content_hashes.values())
+    unscored_ids = []
+    for comment_id in comment_ids:
+        verdict = verdicts.get(content_hashes.get(comment_id))
+        if verdict is not None:
+            classes.setdefault(verdict[0], []).append(comment_id)
         else:
-            comment.is_removed = cls == 'spam'
-            comment.save()
-            classified_comment.cls = cls
-            classified_comment.save()
-            return classified_comment
+            unscored_ids.append(comment_id)
 
-    return classified_comment
+    if classifier is None:
+        classes['unsure'].extend(unscored_ids)
+        return classes
+
+    spam_cutoff = get_setting('SPAM_CUTOFF')
+    ham_cutoff = get_setting('HAM_CUTOFF')
+    probs = classifier.score_many(
+        [texts.get(comment_id) or '' for comment_id in unscored_ids]
+    )
+    new_verdicts = {}
+    for comment_id, prob in zip(unscored_ids, probs):
+        if prob >= spam_cutoff:
+            cls = 'spam'
+        elif prob <= ham_cutoff:
+            cls = 'ham'
+        else:
+            cls = 'unsure'
+        classes.setdefault(cls, []).append(comment_id)
+        new_verdicts[content_hashes.get(comment_id)] = (cls, prob)
+    if verdict_cache is not None:
+        verdict_cache.set_many(new_verdicts)
+    return classes
+
+
+def cache_moderated_verdicts(comment_ids, cls):
+    """
+    Caches moderator decisions to classify comments as cls as the verdicts
+    on their texts, replacing any previous verdicts, i.e. when moderators
+    reverse their decisions.
+    """
+    verdict_cache = get_verdict_cache()
+    if verdict_cache is None or not comment_ids:
+        return
+    from moderator.verdicts import get_content_hash
+    prob = 1.0 if cls == 'spam' else 0.0
+    verdict_cache.set_many(dict(
+        (get_content_hash(text), (cls, prob))
+        for text in Comment.objects.filter(
+            pk__in=comment_ids
+        ).values_list('comment', flat=True)
+    ))
+
+
+def queue_training(comment_ids, cls, previous_classes=None):
+    """
+    Queues classifying comments as cls, superseding any previous moderator
+    decisions previous_classes maps comment ids to, for training the
+    CLASSIFIER if ONLINE_TRAINING_WINDOW is set. Comments are only learned
+    if cls is a moderator decision, previous decisions are unlearned either
+    way.
+
+    Queued decisions are trained on in a batch at most once per that many
+    seconds.
+    """
+    window = get_setting('ONLINE_TRAINING_WINDOW')
+    if not window or not comment_ids or get_classifier() is None:
+        return
+    previous_classes = previous_classes or {}
+    entries = []
+    for comment_id in comment_ids:
+        previous_cls = previous_classes.get(comment_id)
+        if previous_cls in MODERATED_CLASSES:
+            entries.append('unlearn:%s:%s' % (previous_cls, comment_id))
+        if cls in MODERATED_CLASSES:
+            entries.append('learn:%s:%s' % (cls, comment_id))
+    if not entries:
+        return
+    from moderator import tasks
+    tasks.training_queue.add(entries, window)
+
+
+def record_trained_classes(trained_classes):
+    """
+    Records the classes the CLASSIFIER has been trained on comments as, given
+    a dictionary mapping comment ids to classes, or None for comments it has
+    been untrained on.
+    """
+    comment_ids_by_cls = {}
+    for comment_id, cls in trained_classes.items():
+        comment_ids_by_cls.setdefault(cls, []).append(comment_id)
+    for cls, comment_ids in comment_ids_by_cls.items():
+        for offset in range(0, len(comment_ids), BULK_CHUNK_SIZE):
+            models.ClassifiedComment.objects.filter(
+                comment__in=comment_ids[offset:offset + BULK_CHUNK_SIZE]
+            ).update(trained_cls=cls)
+
+
+def get_comment_ids(comments):
+    """
+    Returns a list of unique comment ids for a queryset or sequence of
+    comments/comment ids, preserving order.
+    """
+    if isinstance(comments, QuerySet):
+        comments = comments.values_list('pk', flat=True)
+    comment_ids = []
+    seen = set()
+    for comment in comments:
+        comment_id = getattr(comment, 'pk', comment)
+        if comment_id not in seen:
+            seen.add(comment_id)
+            comment_ids.append(comment_id)
+    return comment_ids
+
+
+def get_reported_comment_ids(comment_ids):
+    """
+    Returns the set of comment ids, out of those provided, reported as abusive
+    at least ABUSE_CUTOFF times.
+    """
+    cutoff = get_setting('ABUSE_CUTOFF')
+    return set(
+        comment_id
+        for comment_id, count in get_abuse_counts(comment_ids).items()
+        if count >= cutoff
+    )
+
+
+def get_abuse_counts(comment_ids):
+    """
+    Returns a dictionary mapping comment ids to the number of times the
+    comments have been reported as abusive. Comments never reported are
+    omitted.
+    """
+    return get_abuse_counter().get_many(comment_ids)
+
+
+def update_abuse_count(comment_id, amount):
+    """
+    Adjusts a comment's abuse count by amount, returning the new count.
+    """
+    return get_abuse_counter().incr(comment_id, amount)
+
+
+def get_setting(name):
+    """
+    Returns a MODERATOR setting, falling back to its default.
+    """
+    moderator_settings = getattr(settings, 'MODERATOR', {})
+    return moderator_settings.get(name, DEFAULT_CONFIG.get(name))
+
+
+def load_class(path):
+    module, attr = path.rsplit('.', 1)
+    return getattr(import_module(module), attr)
+
+
+_abuse_counter = None
+_classifier = None
+_redis_client = None
+
+
+def get_abuse_counter():
+    """
+    Returns the ABUSE_COUNTER backend, instantiated once per process.
+    """
+    global _abuse_counter
+    if _abuse_counter is None:
+        _abuse_counter = load_class(get_setting('ABUSE_COUNTER'))()
+    return _abuse_counter
+
+
+def get_classifier():
+    """
+    Returns the CLASSIFIER backend, configured with CLASSIFIER_CONFIG and
+    instantiated once per process, or None if no classifier is configured.
+    """
+    global _classifier
+    path = get_setting('CLASSIFIER')
+    if path is None:
+        return None
+    if _classifier is None:
+        _classifier = load_class(path)(**get_setting('CLASSIFIER_CONFIG'))
+    return _classifier
+
+
+def get_verdict_cache():
+    """
+    Returns a VerdictCache keeping verdicts for VERDICT_CACHE_TIMEOUT
+    seconds, or None if verdicts aren't cached.
+    """
+    timeout = get_setting('VERDICT_CACHE_TIMEOUT')
+    if not timeout:
+        return None
+    from moderator.verdicts import VerdictCache
+    return VerdictCache(timeout)
+
+
+def get_redis_client():
+    """
+    Returns a REDIS_CLIENT instance configured with the REDIS setting, shared
+    by everything in a process using Redis.
+    """
+    global _redis_client
+    if _redis_client is None:
+        client_class = load_class(get_setting('REDIS_CLIENT'))
+        _redis_client = client_class(**get_setting('REDIS'))
+    return _redis_client
+
+
+def _update_classifications(comment_ids, cls, is_removed=None,
+                            moderated=False):
+    """
+    Sets the class of comments using a single atomic upsert of their
+    classifications and, unless is_removed is None, one update of the
+    comments' is_removed field. moderated records whether the class was set
+    by a moderator.
+
+    Comments have at most one classification, enforced by a unique
+    constraint, so concurrent classification of the same comments can't
+    create duplicates and needs no retries.
+    """
+    if not comment_ids:
+        return
+
+    if not _upsert_classifications(comment_ids, cls, is_removed, moderated):
+        _update_or_create_classifications(
+            comment_ids,
+            cls,
+            is_removed,
+            moderated
+        )
+
+    if is_removed is not None:
+        Comment.objects.filter(pk__in=comment_ids).update(
+            is_removed=is_removed
+        )
+
+
+def _upsert_classifications(comment_ids, cls, is_removed=None,
+                            moderated=False):
+    """
+    Inserts or updates the classifications of comments, along with the
+    fields denormalized from them, in one INSERT ... SELECT statement using
+    the database's upsert syntax.
+
+    Returns False without doing anything if the database has no upsert
+    syntax.
+    """
+    cursor = connection.cursor()
+    vendor = connection.vendor
+    if vendor == 'postgresql':
+        supported = (getattr(connection, 'pg_version', None) or 0) >= 90500
+    elif vendor == 'sqlite':
+        import sqlite3
+        supported = sqlite3.sqlite_version_info >= (3, 24, 0)
+    else:
+        supported = vendor == 'mysql'
+    if not supported:
+        return False
+
+    qn = connection.ops.quote_name
+    update_columns = ['cls', 'moderated']
+    params = [cls, moderated]
+    if is_removed is None:
+        is_removed_sql = 'c.%s' % qn('is_removed')
+    else:
+        is_removed_sql = '%s'
+        params.append(is_removed)
+        update_columns.append('is_removed')
+    params.append(False)
+    params.extend(comment_ids)
+
+    if vendor == 'mysql':
+        conflict_sql = 'ON DUPLICATE KEY UPDATE %s' % ', '.join(
+            '%s = VALUES(%s)' % (qn(column), qn(column))
+            for column in update_columns
+        )
+    else:
+        conflict_sql = 'ON CONFLICT (%s) DO UPDATE SET %s' % (
+            qn('comment_id'),
+            ', '.join(
+                '%s = excluded.%s' % (qn(column), qn(column))
+                for column in update_columns
+            )
+        )
+
+    sql = (
+        'INSERT INTO %(table)s (%(comment_id)s, %(cls)s, %(moderated)s, '
+        '%(submit_date)s, %(is_removed)s, %(site_id)s, %(staff_authored)s) '
+        'SELECT c.%(id)s, %%s, %%s, c.%(submit_date)s, %(is_removed_sql)s, '
+        'c.%(site_id)s, COALESCE(u.%(is_staff)s, %%s) '
+        'FROM %(comments)s c LEFT OUTER JOIN %(users)s u '
+        'ON u.%(id)s = c.%(user_id)s '
+        'WHERE c.%(id)s IN (%(ids)s) %(conflict_sql)s'
+    ) % {
+        'table': qn(models.ClassifiedComment._meta.db_table),
+        'comments': qn(Comment._meta.db_table),
+        'users': qn(User._meta.db_table),
+        'id': qn('id'),
+        'comment_id': qn('comment_id'),
+        'cls': qn('cls'),
+        'moderated': qn('moderated'),
+        'submit_date': qn('submit_date'),
+        'is_removed': qn('is_removed'),
+        'site_id': qn('site_id'),
+        'staff_authored': qn('staff_authored'),
+        'is_staff': qn('is_staff'),
+        'user_id': qn('user_id'),
+        'is_removed_sql': is_removed_sql,
+        'ids': ', '.join(['%s'] * len(comment_ids)),
+        'conflict_sql': conflict_sql,
+    }
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    return True
+
+
+def _update_or_create_classifications(comment_ids, cls, is_removed=None,
+                                      moderated=False):
+    """
+    Fallback for databases without upsert syntax, using one update for
+    comments already classified and one insert for those that are not.
+
+    Should another process classify some of the comments in between the
+    insert fails on the unique constraint, in which case the remaining
+    comments are created or updated one by one.
+    """
+    values = {'cls': cls, 'moderated': moderated}
+    if is_removed is not None:
+        values['is_removed'] = is_removed
+    classified_ids = set(models.ClassifiedComment.objects.filter(
+        comment__in=comment_ids
+    ).values_list('comment_id', flat=True))
+    if classified_ids:
+        models.ClassifiedComment.objects.filter(
+            comment__in=classified_ids
+        ).update(**values)
+
+    unclassified_ids = [i for i in comment_ids if i not in classified_ids]
+    if not unclassified_ids:
+        return
+
+    fields = get_denormalized_fields(unclassified_ids)
+    for comment_id in fields:
+        fields[comment_id].update(values)
+    sid = transaction.savepoint()
+    try:
+        bulk_create(models.ClassifiedComment, [
+            models.ClassifiedComment(
+                comment_id=comment_id,
+                **fields[comment_id]
+            ) for comment_id in unclassified_ids if comment_id in fields
+        ])
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        for comment_id in unclassified_ids:
+            if comment_id not in fields:
+                continue
+            updated = models.ClassifiedComment.objects.filter(
+                comment=comment_id
+            ).update(**values)
+            if not updated:
+                models.ClassifiedComment.objects.create(
+                    comment_id=comment_id,
+                    **fields[comment_id]
+                )
+
+
+def get_denormalized_fields(comment_ids):
+    """
+    Returns a dictionary mapping comment ids to the values of the fields
+    ClassifiedComment denormalizes from comments, using a single query.
+    """
+    comments = Comment.objects.filter(pk__in=comment_ids).values_list(
+        'pk',
+        'submit_date',
+        'is_removed',
+        'site_id',
+        'user__is_staff'
+    )
+    return dict(
+        (pk, {
+            'submit_date': submit_date,
+            'is_removed': is_removed,
+            'site_id': site_id,
+            'staff_authored': bool(is_staff),
+        }) for pk, submit_date, is_removed, site_id, is_staff in comments
+    )
@@ -0,0 +1,62 @@
+import hashlib
+
+from moderator import tokenizer, utils
+
+
+def get_content_hash(text):
+    """
+    Returns a hash of text's normalized tokens, the same for copies of a
+    text differing only in case, spacing, repeated characters, homoglyphs
+    and so on. Returns None for texts without any tokens.
+    """
+    normalized = u' '.join(tokenizer.tokenize(text or ''))
+    if not normalized:
+        return None
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class VerdictCache(object):
+    """
+    Caches the most recent verdict on normalized comment texts, a class and
+    spam probability, in Redis for timeout seconds.
+    """
+    def __init__(self, timeout, prefix='moderator:verdict'):
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get_key(self, content_hash):
+        return '%s:%s' % (self.prefix, content_hash)
+
+    def get_many(self, content_hashes):
+        """
+        Returns a dictionary mapping content hashes to cached (class,
+        probability) verdicts, using a single round trip. Hashes without
+        verdicts are omitted.
+        """
+        content_hashes = [h for h in set(content_hashes) if h is not None]
+        if not content_hashes:
+            return {}
+        values = utils.get_redis_client().mget(
+            [self.get_key(h) for h in content_hashes]
+        )
+        verdicts = {}
+        for content_hash, value in zip(content_hashes, values):
+            if value:
+                cls, prob = value.split(':')
+                verdicts[content_hash] = (cls, float(prob))
+        return verdicts
+
+    def set_many(self, verdicts):
+        """
+        Caches (class, probability) verdicts given by a dictionary mapping
+        content hashes to them, replacing previous verdicts.
+        """
+        pipe = utils.get_redis_client().pipeline(transaction=False)
+        for content_hash, (cls, prob) in verdicts.items():
+            if content_hash is not None:
+                pipe.setex(
+                    self.get_key(content_hash),
+                    self.timeout,
+                    '%s:%s' % (cls, prob)
+                )
+        pipe.execute()
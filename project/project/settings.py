@@ -169,7 +169,7 @@ LOGGING = {
 }
 
 MODERATOR = {
-    'CLASSIFIER': 'moderator.storage.DjangoClassifier',
+    'CLASSIFIER': 'moderator.storage.RedisClassifier',
     'HAM_CUTOFF': 0.3,
     'SPAM_CUTOFF': 0.7,
     'ABUSE_CUTOFF': 1,
@@ -15,6 +15,7 @@ setup(
     install_requires=[
         'django-apptemplates',
         'django-likes>=0.0.6',
+        'numpy',
         'redis',
         'unidecode',
         'django-celery',
@@ -24,6 +24,7 @@ MODERATOR = {
     'HAM_CUTOFF': 0.3,
     'SPAM_CUTOFF': 0.7,
     'ABUSE_CUTOFF': 3,
+    'REDIS_CLIENT': 'fakeredis.FakeStrictRedis',
 }
 
 ROOT_URLCONF = 'test_urls'